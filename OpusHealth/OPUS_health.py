@@ -1,18 +1,25 @@
 import os
-import json
+import logging
+import threading
+import xml.etree.ElementTree as ET
 # 3rd part imports
-import requests
-import xmltodict
+from http_transport import AsyncWrapper, get_session
+
+
+# (user, password, groupid) -> rendered SOAP envelope (bytes)
+_envelopes = {}
 
 
 class OpusHealthPartnerInterface:
     """The OPUS Health Partner Interface web service will provide external partners with the ability to communicate with Alternative Sampling platform in real time:"""
 
-    def __init__(self, logger):
+    def __init__(self, logger, connect_timeout=3.05, read_timeout=10):
         """
 
         Args:
             - logger (obj): import logger object using the singleton pattern
+            - connect_timeout (float): Seconds to wait for a connection to the API
+            - read_timeout (float): Seconds to wait for the API to respond
         """
         self.__logger = logger
         self.headers = {
@@ -24,6 +31,7 @@ class OpusHealthPartnerInterface:
         self.user = None
         self.password = None
         self.groupid = None
+        self.timeout = (connect_timeout, read_timeout)
 
     def set_meta(self, url, user, password, groupid):
         """_summary_
@@ -48,10 +56,20 @@ class OpusHealthPartnerInterface:
         return True
 
     def set_payload(self):
-        """Creates the payload for the api request"""
+        """Creates the payload for the api request
+
+        The envelope only changes with the credentials and group, so it is
+        rendered and encoded once per (user, groupid) and then reused.
+        """
+
+        key = (self.user, self.password, self.groupid)
+
+        if key in _envelopes:
+            self.payload = _envelopes[key]
+            return
 
         # build the XML payload
-        self.payload = f"""
+        payload = f"""
         <soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:par="http://www.tripleiesampling.com/PartnerInterfaceWS/">
         <soapenv:Header>
             <par:ESamplingSoapHeader>
@@ -67,42 +85,219 @@ class OpusHealthPartnerInterface:
     </soapenv:Envelope>"""
 
         self.__logger.info(
-            f'OpusHealthPartnerInterface.set_payload: xmldata: {self.payload}')
+            f'OpusHealthPartnerInterface.set_payload: xmldata: {payload}')
+
+        self.payload = _envelopes[key] = payload.encode("utf-8")
 
     def post_request(self):
         """Send a request to the OPUS API
 
+        The request is sent on a pooled keep-alive session for the endpoint.
+        gzip/deflate responses are decompressed by requests, use `r.text`.
+
         Returns:
-            XML: returns and xml object 
+            XML: returns and xml object, or None if the request failed
         """
 
         self.set_payload()
 
         try:
-            r = requests.post(
-                self.url, data=self.payload, headers=self.headers)
+            r = get_session(self.url).post(
+                self.url, data=self.payload, headers=self.headers, timeout=self.timeout)
             self.__logger.info(
                 f'OpusHealthPartnerInterface.post_request: API response status code: {r.status_code}')
 
         except Exception as e:
             self.__logger.error(
                 f'OpusHealthPartnerInterface.post_request: API failed: \n\n {e}')
+            return None
 
         return r
 
-    def get_document_number(self, xml_str):
+    def get_document_number(self, xml_str, chunk_size=4096):
         """Extract the document number from the xml data that was recevied from the request
 
+        The response is parsed incrementally and parsing stops at the first
+        `DocumentNumber` element, whatever namespace prefix the server uses.
+
         Args:
             xml_str (str): Data is received as a string
+            chunk_size (int): How much of the response is fed to the parser at a time
+
+        Returns:
+            str: the document number, or None if the response does not contain one
         """
 
-        # convert response xml to dict
-        xml_response = xmltodict.parse(xml_str)
+        # only format the full response when debug logging is on
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug(
+                f'OpusHealthPartnerInterface.get_document_number: xml_response \n{xml_str}')
+
+        parser = ET.XMLPullParser(events=("end",))
+
+        for i in range(0, len(xml_str), chunk_size):
+            parser.feed(xml_str[i:i + chunk_size])
+
+            for _, element in parser.read_events():
+                # tags are "{namespace}DocumentNumber" or plain "DocumentNumber"
+                if element.tag.rpartition("}")[2] == "DocumentNumber":
+                    return element.text
+
+        self.__logger.error(
+            'OpusHealthPartnerInterface.get_document_number: DocumentNumber not found')
+        return None
+
+
+class DocumentNumberPool:
+    """Keeps Opus document numbers reserved ahead of demand
+
+    Numbers are fetched in a background thread whenever the pool drops below
+    `low_water`, so the SOAP round trip is off the request path. When a
+    DynamoDB table is given every reserved number is stored there until it is
+    used, so numbers survive a container recycle and are shared between
+    containers. The table needs a `groupid` partition key and a
+    `document_number` sort key.
+    """
+
+    def __init__(self, interface, logger, size=10, low_water=3, table_name=None):
+        """
+
+        Args:
+            - interface (obj): An OpusHealthPartnerInterface with set_meta already called
+            - logger (obj): import logger object using the singleton pattern
+            - size (int): The number of document numbers to keep reserved
+            - low_water (int): Refill in the background below this many numbers
+            - table_name (str): Optional DynamoDB table used to persist unused numbers
+        """
+        self.__logger = logger
+        self.interface = interface
+        self.size = size
+        self.low_water = low_water
+        self.dynamo = None
+        self.table = None
+        self.__numbers = []
+        self.__lock = threading.Lock()
+        self.__refill_thread = None
+
+        if table_name:
+            from aws.dynamo import Dynamo
+
+            self.dynamo = Dynamo(logger)
+            self.dynamo.set_table(table_name)
+            self.table = self.dynamo.table
+            response = self.table.query(
+                KeyConditionExpression="groupid = :groupid",
+                ExpressionAttributeValues={":groupid": self.interface.groupid},
+                Limit=self.size)
+            self.__numbers = [item["document_number"]
+                              for item in response.get("Items", [])]
+
+    def get(self):
+        """Take a reserved document number, fetching one directly if the pool is empty
+
+        Returns:
+            str: the document number, or None if it could not be fetched
+        """
+
+        number = None
+
+        while number is None:
+            with self.__lock:
+                if not self.__numbers:
+                    break
+                candidate = self.__numbers.pop(0)
+
+            if self.__claim(candidate):
+                number = candidate
+
+        self.__maybe_refill()
+
+        if number is None:
+            self.__logger.info("DocumentNumberPool.get: pool empty, fetching directly")
+            number = self.__fetch_one()
+
+        return number
+
+    def refill(self):
+        """Fetch numbers until the pool is full"""
+
+        self.__logger.info("DocumentNumberPool.refill: start")
+
+        while len(self.__numbers) < self.size:
+            number = self.__fetch_one()
+            if number is None:
+                break
+
+            if self.dynamo is not None:
+                self.dynamo.dynamo_post({
+                    "groupid": self.interface.groupid,
+                    "document_number": number
+                })
+
+            with self.__lock:
+                self.__numbers.append(number)
 
         self.__logger.info(
-            f'OpusHealthPartnerInterface.get_document_number: xml_response \n{json.dumps(xml_response, indent=4)}')
+            f"DocumentNumberPool.refill: end - {len(self.__numbers)} reserved")
+
+    def __maybe_refill(self):
+        """Start a background refill below the low-water mark"""
+
+        with self.__lock:
+            if len(self.__numbers) >= self.low_water:
+                return
+            if self.__refill_thread is not None and self.__refill_thread.is_alive():
+                return
+
+            self.__refill_thread = threading.Thread(target=self.refill, daemon=True)
+            self.__refill_thread.start()
+
+    def __claim(self, number):
+        """Remove a number from the table so no other container can use it"""
+
+        if self.table is None:
+            return True
+
+        try:
+            self.table.delete_item(
+                Key={"groupid": self.interface.groupid, "document_number": number},
+                ConditionExpression="attribute_exists(document_number)")
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            # another container already used it
+            return False
+        except Exception as e:
+            self.__logger.error(f"DocumentNumberPool.__claim: {e}")
+            return False
+
+        return True
+
+    def __fetch_one(self):
+        """Request a single document number from the Opus API"""
+
+        try:
+            r = self.interface.post_request()
+            return self.interface.get_document_number(r.text)
+        except Exception as e:
+            self.__logger.error(f"DocumentNumberPool.__fetch_one: {e}")
+            return None
+
+
+class AsyncOpusHealthPartnerInterface(AsyncWrapper):
+    """asyncio counterpart of OpusHealthPartnerInterface, takes the same arguments
+
+    The envelope and the response parsing are shared with the wrapped interface.
+    """
 
-        # get the document number
-        return xml_response["soap:Envelope"]["soap:Body"]["GetNextAvailableDocumentNumberResponse"][
-            "GetNextAvailableDocumentNumberResult"]["DocumentNumber"]
+    sync_class = OpusHealthPartnerInterface
+    async_methods = ("post_request",)
+
+    async def fetch_document_number(self):
+        """Request and extract the next document number
+
+        Returns:
+            str: the document number, or None if the request failed
+        """
+        r = await self.post_request()
+        if r is None:
+            return None
+        return self.sync.get_document_number(r.text)
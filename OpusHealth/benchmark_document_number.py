@@ -0,0 +1,49 @@
+"""Compare xmltodict + json.dumps with the incremental DocumentNumber extractor
+
+Usage: python benchmark_document_number.py [iterations]
+"""
+import os
+import sys
+import json
+import logging
+import timeit
+
+import xmltodict
+
+# http_transport lives in the repo root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from OPUS_health import OpusHealthPartnerInterface  # noqa: E402
+
+RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+    <soap:Body>
+        <GetNextAvailableDocumentNumberResponse xmlns="http://www.tripleiesampling.com/PartnerInterfaceWS/">
+            <GetNextAvailableDocumentNumberResult>
+                <DocumentNumber>12345678901</DocumentNumber>
+                <ResponseCode>0</ResponseCode>
+                <ResponseMessage>Success</ResponseMessage>
+            </GetNextAvailableDocumentNumberResult>
+        </GetNextAvailableDocumentNumberResponse>
+    </soap:Body>
+</soap:Envelope>"""
+
+
+def old_path(xml_str):
+    """the previous implementation: full dict conversion plus indented log dump"""
+    xml_response = xmltodict.parse(xml_str)
+    json.dumps(xml_response, indent=4)
+    return xml_response["soap:Envelope"]["soap:Body"]["GetNextAvailableDocumentNumberResponse"][
+        "GetNextAvailableDocumentNumberResult"]["DocumentNumber"]
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    logging.basicConfig(level=logging.WARNING)
+    opus = OpusHealthPartnerInterface(logging.getLogger())
+
+    assert old_path(RESPONSE) == opus.get_document_number(RESPONSE)
+
+    for name, func in (("old", old_path), ("new", opus.get_document_number)):
+        seconds = min(timeit.repeat(lambda: func(RESPONSE), number=iterations, repeat=5))
+        print(f"{name}: {seconds / iterations * 1e6:.1f}us per response")
@@ -0,0 +1,77 @@
+"""Count the identity calls Marketo makes while its access token is about to expire
+
+The real MarketoClient is used, only its HTTP layer is replaced: the identity
+endpoint keeps handing back the same token until it has expired, the way
+Marketo does. Needs marketorestpython installed.
+
+Usage: python check_token_reuse.py [leads]
+"""
+import os
+import sys
+import time
+import logging
+
+# http_transport lives in the repo root
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from marketorestpython.client import MarketoClient  # noqa: E402
+
+os.environ.setdefault("munchkin_id", "000-AAA-000")
+os.environ.setdefault("client_id", "client")
+os.environ.setdefault("client_secret", "secret")
+os.environ.setdefault("list_id", "1")
+
+import marketo  # noqa: E402
+
+# seconds left on the token the first time it is requested
+TOKEN_SECONDS_LEFT = 30
+
+clock = {"now": time.time()}
+identity = {"calls": 0, "token": 0, "expires": clock["now"] + TOKEN_SECONDS_LEFT}
+
+
+def fake_api_call(self, method, endpoint, args=None, data=None, **kwargs):
+    if endpoint.endswith("/identity/oauth/token"):
+        identity["calls"] += 1
+        # a new token only once the old one has expired
+        if clock["now"] >= identity["expires"]:
+            identity["token"] += 1
+            identity["expires"] = clock["now"] + 3600
+        return {"access_token": f"token-{identity['token']}", "token_type": "bearer",
+                "expires_in": int(identity["expires"] - clock["now"]), "scope": "api"}
+
+    return {"success": True, "result": [{"id": i, "status": "created"} for i, _ in enumerate(data["input"])]}
+
+
+def run(func):
+    """Returns the number of identity calls `func` made"""
+    before = identity["calls"]
+    func()
+    return identity["calls"] - before
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 900
+    logging.basicConfig(level=logging.WARNING)
+    MarketoClient._api_call = fake_api_call
+    time.time = lambda: clock["now"]
+
+    records = [{"email": f"lead{i}@example.com", "first_name": "a", "last_name": "b"}
+               for i in range(count)]
+    leads = [{"email": r["email"], "firstName": "a", "lastName": "b"} for r in records]
+    chunks = [leads[i:i + marketo.BATCH_SIZE] for i in range(0, count, marketo.BATCH_SIZE)]
+
+    bare = MarketoClient("000-AAA-000", "client", "secret")
+    bare_calls = run(lambda: [bare.execute(method="create_update_leads", leads=chunk) for chunk in chunks])
+
+    client = marketo.Marketo(logging.getLogger())
+    calls = run(lambda: client.create_leads(records))
+    print(f"{len(chunks)} chunks, {TOKEN_SECONDS_LEFT}s left on the token: "
+          f"MarketoClient {bare_calls} identity calls, Marketo {calls}")
+    assert calls == 1, calls
+
+    # once the token has expired a single call gets the new one
+    clock["now"] = identity["expires"] + 1
+    calls = run(lambda: client.create_leads(records))
+    print(f"after it expired: Marketo {calls} identity calls, token-{identity['token']}")
+    assert calls == 1 and client.mc.token == f"token-{identity['token']}"
@@ -1,8 +1,57 @@
 import os
+import csv
+import time
 # 3rd party imports
+from http_transport import get_session
 # source https://github.com/jepcastelein/marketo-rest-python
 from marketorestpython.client import MarketoClient
 
+# The most records Marketo accepts in a single lead or list request
+BATCH_SIZE = 300
+# Marketo rejects bulk import files over 10MB, leave some headroom
+IMPORT_FILE_LIMIT = 9 * 1024 * 1024
+# MarketoClient.authenticate() calls the identity endpoint whenever the token
+# has less than this many seconds left. Before it expires Marketo only hands
+# back the same token.
+TOKEN_REFRESH_MARGIN = 60
+
+# (munchkin_id, client_id) -> MarketoClient
+_clients = {}
+
+
+class DynamoTokenCache():
+    """Shares Marketo access tokens between containers through DynamoDB
+
+    The table needs a string partition key named `cache_key`.
+    """
+
+    def __init__(self, logger, table_name):
+        """
+        args:
+            - logger (obj): import logger object using the singleton pattern
+            - table_name (str): The DynamoDB table the tokens are stored in
+        """
+        from aws.dynamo import Dynamo
+
+        self.dynamo = Dynamo(logger)
+        self.dynamo.set_table(table_name)
+
+    def get(self, key):
+        """Returns (token, valid_until) or None"""
+        item = self.dynamo.table.get_item(Key={"cache_key": key}).get("Item")
+        if item is None:
+            return None
+        return item["token"], float(item["valid_until"])
+
+    def put(self, key, token, valid_until):
+        self.dynamo.dynamo_post({
+            "cache_key": key,
+            "token": token,
+            "valid_until": int(valid_until),
+            # lets DynamoDB TTL clean up expired tokens
+            "expires_at": int(valid_until)
+        })
+
 
 class Marketo():
     """
@@ -10,10 +59,12 @@ class Marketo():
     Docs: https://developers.marketo.com/rest-api/
     """
 
-    def __init__(self, logger):
+    def __init__(self, logger, token_cache=None):
         """
         args:
             - logger (obj): import logger object using the singleton pattern
+            - token_cache (obj): Optional shared token cache, ex: DynamoTokenCache.
+              Defaults to a DynamoTokenCache on the `marketo_token_table` env var when set.
         """
         self.munchkin_id = os.environ["munchkin_id"]  # fill in Munchkin ID, typical format 000-AAA-000
         # enter Client ID from Admin > LaunchPoint > View Details
@@ -25,9 +76,78 @@ class Marketo():
         # how to find list id
         # https://learn.azuqua.com/connector-reference/marketo/#:~:text=Note%3A%20in%20order%20to%20find,.marketo.com%2F%23SL2323B2.
         self.list_id = os.environ["list_id"]
-        self.mc = MarketoClient(self.munchkin_id, self.client_id,
-                                self.client_secret, self.api_limit, self.max_retry_time)
         self.__logger = logger
+        if token_cache is None and os.environ.get("marketo_token_table"):
+            token_cache = DynamoTokenCache(logger, os.environ["marketo_token_table"])
+        self.token_cache = token_cache
+        # api calls made by the batch methods, and how many the batching saved
+        self.api_calls = 0
+        self.api_calls_saved = 0
+
+    @property
+    def mc(self):
+        """The MarketoClient shared by every Marketo in the container, with a fresh token
+
+        The client is only built on first use and its token is refreshed
+        once it is about to expire, so handlers don't pay an identity call
+        on every instantiation.
+        """
+        key = (self.munchkin_id, self.client_id)
+
+        if key not in _clients:
+            _clients[key] = MarketoClient(self.munchkin_id, self.client_id,
+                                          self.client_secret, self.api_limit, self.max_retry_time)
+
+        mc = _clients[key]
+        if mc.valid_until is None or mc.valid_until - time.time() < TOKEN_REFRESH_MARGIN:
+            self.__refresh_token(mc, key)
+
+        return mc
+
+    def __refresh_token(self, mc, key):
+        """Load a token from the shared cache, or request a new one and share it"""
+
+        cache_key = f"{key[0]}:{key[1]}"
+
+        if self.token_cache is not None:
+            try:
+                cached = self.token_cache.get(cache_key)
+            except Exception as e:
+                self.__logger.error(f'Marketo.refresh_token: cache get failed - {e}')
+                cached = None
+
+            if cached is not None and cached[1] - time.time() >= TOKEN_REFRESH_MARGIN:
+                mc.token, mc.valid_until = cached
+                mc.token_type = 'bearer'
+                self.__logger.info('Marketo.refresh_token: using shared token')
+                return
+
+        mc.authenticate()
+
+        if mc.valid_until - time.time() < TOKEN_REFRESH_MARGIN:
+            # Marketo handed back the token that is about to expire. Keep
+            # valid_until above the client's margin until the token really
+            # expires, otherwise every API method calls the identity endpoint
+            # again. Once it has expired the client requests a new one itself.
+            mc.valid_until += TOKEN_REFRESH_MARGIN - 1
+            self.__logger.info('Marketo.refresh_token: token unchanged until it expires')
+            return
+
+        self.__logger.info('Marketo.refresh_token: requested a new token')
+
+        if self.token_cache is not None:
+            try:
+                self.token_cache.put(cache_key, mc.token, mc.valid_until)
+            except Exception as e:
+                self.__logger.error(f'Marketo.refresh_token: cache put failed - {e}')
+
+    def build_lead(self, data):
+        """Map the data received by the lambda function to a Marketo lead
+        args:
+            - data (json): the data received by the lambda function
+        """
+        return {"email": data["email"],
+                "firstName": data["first_name"], "lastName": data["last_name"]}
 
     def create_lead(self, data):
         """Upload a contact as a lead into the Marketo DB
@@ -40,13 +160,8 @@ class Marketo():
 
         self.__logger.info('Marketo.create_lead: Start...')
 
-        email = data["email"]
-        first_name = data["first_name"]
-        last_name = data["last_name"]
-
         # store lead as an array
-        leads = [{"email": email,
-                  "firstName": first_name, "lastName": last_name}]
+        leads = [self.build_lead(data)]
 
         try:
             # Try to create the lead
@@ -84,3 +199,271 @@ class Marketo():
         self.__logger.info('Marketo.add_to_list: Success!')
         self.__logger.info(f'Marketo.add_to_list: {response}')
         return response
+
+    def create_leads(self, records):
+        """Upload many contacts as leads, up to 300 per API call
+        args:
+             - records (list): the data received by the lambda function, one dict per lead
+        Response (array): one result per record, in the same order as `records`
+            - Success: {'email': 'post@man.com', 'id': 43471, 'status': 'created'}
+            - Duplicate: {'email': 'post@man.com', 'status': 'skipped', 'reasons': [...]}
+            - Failed request: {'email': 'post@man.com', 'status': 'failed', 'reasons': ['...']}
+            - Invalid record: {'email': None, 'status': 'failed', 'reasons': ["invalid record: 'last_name'"]}
+        """
+
+        self.__logger.info(f'Marketo.create_leads: Start... {len(records)} leads')
+
+        results = []
+
+        for start in range(0, len(records), BATCH_SIZE):
+            chunk = records[start:start + BATCH_SIZE]
+            # one slot per record, None until the API answers for it
+            chunk_results = []
+            leads = []
+
+            for data in chunk:
+                try:
+                    leads.append(self.build_lead(data))
+                    chunk_results.append(None)
+                except Exception as e:
+                    # a malformed record fails on its own, the rest are still sent
+                    self.__logger.error(f'Marketo.create_leads: invalid record - {e}')
+                    email = data.get('email') if isinstance(data, dict) else None
+                    chunk_results.append(
+                        {'email': email, 'status': 'failed', 'reasons': [f'invalid record: {e}']})
+
+            if leads:
+                try:
+                    response = self.mc.execute(method='create_update_leads', leads=leads, action='createOnly',
+                                               lookupField='email', asyncProcessing='false',
+                                               partitionName='Default')
+                    self.__count_call(len(leads))
+                except Exception as e:
+                    self.__logger.error(f'Marketo.create_leads: failed - {e}')
+                    response = [{'status': 'failed', 'reasons': [str(e)]}] * len(leads)
+
+                # results come back in the order the leads were sent
+                sent = iter(zip(leads, response))
+                for i, result in enumerate(chunk_results):
+                    if result is None:
+                        lead, result = next(sent)
+                        chunk_results[i] = {'email': lead['email'], **result}
+
+            results.extend(chunk_results)
+
+        self.__logger.info(
+            f'Marketo.create_leads: end - api_calls: {self.api_calls} saved: {self.api_calls_saved}')
+        return results
+
+    def add_leads_to_list(self, lead_ids):
+        """Add many leads to the marketo list, up to 300 per API call
+        args:
+            - lead_ids (list): The IDs of the leads we want to add to the list
+        Response (array):
+            - Success: [{'id': 43471, 'status': 'added'}, ...]
+            - Failed request: [{'id': 43471, 'status': 'failed', 'reasons': ['...']}, ...]
+        """
+
+        self.__logger.info(f'Marketo.add_leads_to_list: Start... {len(lead_ids)} leads')
+
+        results = []
+
+        for start in range(0, len(lead_ids), BATCH_SIZE):
+            chunk = lead_ids[start:start + BATCH_SIZE]
+
+            try:
+                response = self.mc.execute(
+                    method='add_leads_to_list', listId=self.list_id, id=chunk)
+                self.__count_call(len(chunk))
+            except Exception as e:
+                self.__logger.error(f'Marketo.add_leads_to_list: failed - {e}')
+                results.extend({'id': lead_id, 'status': 'failed', 'reasons': [str(e)]}
+                               for lead_id in chunk)
+                continue
+
+            results.extend(response)
+
+        self.__logger.info('Marketo.add_leads_to_list: end')
+        return results
+
+    def create_leads_and_add_to_list(self, records):
+        """Create many leads and add every created lead to the list in bulk
+        args:
+             - records (list): the data received by the lambda function, one dict per lead
+        Response (array): one result per record, in the same order as `records`
+            - {'email': 'post@man.com', 'id': 43471, 'status': 'created', 'list_status': 'added'}
+        """
+
+        results = self.create_leads(records)
+
+        created_ids = [result['id'] for result in results if result.get('status') == 'created']
+        list_status = {result['id']: result['status']
+                       for result in self.add_leads_to_list(created_ids)
+                       if 'id' in result}
+
+        for result in results:
+            if 'id' in result:
+                result['list_status'] = list_status.get(result['id'], 'unknown')
+
+        return results
+
+    def bulk_import_leads(self, records, list_id=None, workdir="/tmp"):
+        """Submit leads to the Bulk Lead Import API as CSV files
+
+        `records` can be any iterable (ex: a generator reading from S3). Rows are
+        written straight to a CSV file on disk and a new import job is started
+        each time the file nears the 10MB limit, so memory stays flat no matter
+        how many leads there are. Use `get_import_status` or `poll_import_status`
+        to follow the jobs.
+        args:
+            - records (iterable): the data received by the lambda function, one dict per lead
+            - list_id (str): Optional list the leads are added to
+            - workdir (str): Where the CSV chunks are written
+        Response (dict):
+            - Success: {'ok': True, 'batch_ids': [1022, 1023], 'rows_submitted': 120000, 'error': None}
+            - Failed: {'ok': False, 'batch_ids': [1022], 'rows_submitted': 60000, 'error': '...'}
+              rows after `rows_submitted` were not imported, resume from there
+        """
+
+        self.__logger.info('Marketo.bulk_import_leads: Start...')
+
+        result = {'ok': True, 'batch_ids': [], 'rows_submitted': 0, 'error': None}
+        path = os.path.join(workdir, f"marketo_import_{os.getpid()}.csv")
+        fieldnames = ["email", "firstName", "lastName"]
+        f = None
+        rows = 0
+
+        try:
+            for data in records:
+                if f is None:
+                    f = open(path, "w", newline="", encoding="utf-8")
+                    writer = csv.DictWriter(f, fieldnames=fieldnames)
+                    writer.writeheader()
+
+                writer.writerow(self.build_lead(data))
+                rows += 1
+
+                if f.tell() >= IMPORT_FILE_LIMIT:
+                    f.close()
+                    f = None
+                    result['batch_ids'].append(self.__submit_import(path, list_id))
+                    result['rows_submitted'] += rows
+                    rows = 0
+
+            if f is not None:
+                f.close()
+                f = None
+                result['batch_ids'].append(self.__submit_import(path, list_id))
+                result['rows_submitted'] += rows
+
+        except Exception as e:
+            self.__logger.error(f'Marketo.bulk_import_leads: failed - {e}')
+            result['ok'] = False
+            result['error'] = str(e)
+
+        finally:
+            if f is not None:
+                f.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.__logger.info(f'Marketo.bulk_import_leads: end - {result}')
+        return result
+
+    def get_import_status(self, batch_id):
+        """Check the status of an import job once, without waiting
+        args:
+            - batch_id (int): The batch id returned by `bulk_import_leads`
+        Response (dict): the status, or None if it could not be read
+            - {'batchId': 1022, 'status': 'Importing', 'numOfLeadsProcessed': 2,
+               'numOfRowsFailed': 1, 'numOfRowsWithWarning': 0}
+        """
+
+        try:
+            status = self.mc.execute(method='get_import_lead_status', id=batch_id)[0]
+            self.__count_call(1)
+        except Exception as e:
+            self.__logger.error(f'Marketo.get_import_status: failed - {e}')
+            return None
+
+        self.__logger.info(f'Marketo.get_import_status: {status}')
+        return status
+
+    def poll_import_status(self, batch_id, max_wait=60, initial_delay=5, max_delay=30):
+        """Wait for an import job to finish, backing off between status checks
+
+        This blocks the handler. Large imports can take longer than a lambda
+        runs, for those call `get_import_status` from a later invocation
+        (ex: a Step Functions wait loop or a delayed SQS message) instead.
+        args:
+            - batch_id (int): The batch id returned by `bulk_import_leads`
+            - max_wait (int): Give up after this many seconds
+            - initial_delay (int): Seconds before the first status check, doubled each time
+            - max_delay (int): The longest wait between status checks
+        Response (dict): the last status received, or None if the status could not be read
+            - {'batchId': 1022, 'status': 'Complete', 'numOfLeadsProcessed': 2,
+               'numOfRowsFailed': 1, 'numOfRowsWithWarning': 0}
+        """
+
+        self.__logger.info(f'Marketo.poll_import_status: Start... batch {batch_id}')
+
+        deadline = time.time() + max_wait
+        delay = initial_delay
+        status = None
+
+        while time.time() + delay <= deadline:
+            time.sleep(delay)
+
+            status = self.get_import_status(batch_id)
+
+            if status is None or status['status'] in ('Complete', 'Failed'):
+                break
+
+            delay = min(delay * 2, max_delay)
+
+        return status
+
+    def iter_import_failures(self, batch_id):
+        """Stream the failure file of an import job, one dict per failed row
+        args:
+            - batch_id (int): The batch id returned by `bulk_import_leads`
+        """
+        return self.__iter_import_file(batch_id, "failures")
+
+    def iter_import_warnings(self, batch_id):
+        """Stream the warning file of an import job, one dict per row with a warning
+        args:
+            - batch_id (int): The batch id returned by `bulk_import_leads`
+        """
+        return self.__iter_import_file(batch_id, "warnings")
+
+    def __iter_import_file(self, batch_id, kind):
+        """Stream a failure or warning CSV from the bulk api without loading it all"""
+
+        mc = self.mc
+        url = f"{mc.host}/bulk/v1/leads/batch/{batch_id}/{kind}.json"
+
+        with get_session(url).get(url, headers={"Authorization": f"Bearer {mc.token}"},
+                                   stream=True, timeout=(3.05, 60)) as r:
+            r.raise_for_status()
+            self.__count_call(1)
+            r.encoding = r.encoding or "utf-8"
+            yield from csv.DictReader(r.iter_lines(decode_unicode=True))
+
+    def __submit_import(self, path, list_id):
+        """Start a bulk import job for a CSV file and return its batch id"""
+
+        args = {'format': 'csv', 'file': path, 'lookupField': 'email'}
+        if list_id is not None:
+            args['listId'] = list_id
+
+        response = self.mc.execute(method='import_lead', **args)
+        self.__count_call(1)
+
+        self.__logger.info(f'Marketo.bulk_import_leads: submitted {response}')
+        return response[0]['batchId']
+
+    def __count_call(self, records):
+        """Track one api call that carried `records` records"""
+        self.api_calls += 1
+        self.api_calls_saved += records - 1
@@ -125,6 +125,32 @@ class Dynamo:
                 "body": json.dumps({"message": "Unable to POST items."}),
             }
 
+    def dynamo_batch_post(self, items):
+        """
+        Add many items to the DB, 25 per BatchWriteItem request
+        args:
+            - items (list): the items we're adding to the db
+        """
+
+        self.__logger.info(f"Dynamo.dynamo_batch_post: start - {len(items)} items")
+
+        try:
+            # batch_writer buffers the puts and resends unprocessed items
+            with self.table.batch_writer() as batch:
+                for item in items:
+                    batch.put_item(Item=item)
+            self.__logger.info("Dynamo.dynamo_batch_post: success")
+            return True
+
+        except Exception as e:
+            # display failure message and return failure status
+            self.__logger.error(f"Dynamo.dynamo_batch_post: failed...\n\n\n {e}")
+
+            return {
+                "statusCode": 500,
+                "body": json.dumps({"message": "Unable to POST items."}),
+            }
+
     def dynamo_get_item(self, key_name, key_value):
         """
         get a single item from DynamoDb
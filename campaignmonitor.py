@@ -1,7 +1,11 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 # 3rd party
-import requests
+from http_transport import AsyncWrapper, get_session
+
+# The most subscribers Campaign Monitor accepts in a single import
+IMPORT_BATCH_SIZE = 1000
 
 
 class CampaignMonitor:
@@ -17,6 +21,7 @@ class CampaignMonitor:
         self.__LIST_API_ID = os.environ["list_api_id"]
         self.__PASSWORD = os.environ["password"]
         self.__SUBSCRIBER_API_URL = f"https://api.createsend.com/api/v3.3/subscribers/{self.__LIST_API_ID}.json"
+        self.__IMPORT_API_URL = f"https://api.createsend.com/api/v3.3/subscribers/{self.__LIST_API_ID}/import.json"
         self.__HEADERS = {
             'Content-Type': 'application/json',
         }
@@ -52,7 +57,7 @@ class CampaignMonitor:
             f"CampaignMonitor.add_subscriber_to_list: payload: {payload}")
 
         try:
-            r = requests.post(self.__SUBSCRIBER_API_URL, auth=(self.__API_KEY, self.__PASSWORD),
+            r = get_session(self.__SUBSCRIBER_API_URL).post(self.__SUBSCRIBER_API_URL, auth=(self.__API_KEY, self.__PASSWORD),
                               headers=self.__HEADERS, data=payload)
         except Exception as e:
             self.__logger.error(f"CampaignMonitor.add_subscriber_to_list: {e}")
@@ -69,3 +74,112 @@ class CampaignMonitor:
 
         # success
         return True
+
+    def import_subscribers(self, subscribers, max_workers=4, retries=1, resubscribe=True):
+        """Import many subscribers, up to 1000 per request
+
+        source: https://www.campaignmonitor.com/api/v3-3/subscribers/#importing-many-subscribers
+
+        The subscribers are split into chunks which are posted concurrently.
+        Entries listed in `FailureDetails` are resubmitted on their own, up to
+        `retries` times.
+
+        Args:
+            subscribers (list): subscriber dicts, see `add_subscriber_to_list` for the format
+            max_workers (int): The number of chunks posted at once
+            retries (int): How many times failed entries are resubmitted
+            resubscribe (bool): Resubscribe addresses that unsubscribed
+
+        Returns:
+            dict: EmailAddress -> result
+                Ex: {"post@man.com": {"ok": True, "code": None, "message": None}}
+        """
+
+        self.__logger.info(
+            f"CampaignMonitor.import_subscribers: start - {len(subscribers)} subscribers")
+
+        results = {}
+        pending = subscribers
+
+        for attempt in range(retries + 1):
+            chunks = [pending[i:i + IMPORT_BATCH_SIZE]
+                      for i in range(0, len(pending), IMPORT_BATCH_SIZE)]
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                failures = {}
+                for chunk_failures in executor.map(
+                        lambda chunk: self.__import_chunk(chunk, resubscribe), chunks):
+                    failures.update(chunk_failures)
+
+            for subscriber in pending:
+                email = subscriber["EmailAddress"]
+                results[email] = failures.get(
+                    email, {"ok": True, "code": None, "message": None})
+
+            pending = [subscriber for subscriber in pending
+                       if subscriber["EmailAddress"] in failures]
+
+            if not pending:
+                break
+
+            self.__logger.info(
+                f"CampaignMonitor.import_subscribers: {len(pending)} failed on attempt {attempt + 1}")
+
+        self.__logger.info(
+            f"CampaignMonitor.import_subscribers: end - {len(pending)} failed")
+        return results
+
+    def __import_chunk(self, chunk, resubscribe):
+        """Post one chunk to the import endpoint
+
+        Returns:
+            dict: EmailAddress -> result for every entry that failed
+        """
+
+        body = {
+            "Subscribers": chunk,
+            "Resubscribe": resubscribe,
+            "QueueSubscriptionBasedAutoResponders": False,
+            "RestartSubscriptionBasedAutoresponders": True
+        }
+
+        try:
+            r = get_session(self.__IMPORT_API_URL).post(self.__IMPORT_API_URL, auth=(self.__API_KEY, self.__PASSWORD),
+                              headers=self.__HEADERS, data=json.dumps(body))
+        except Exception as e:
+            self.__logger.error(f"CampaignMonitor.import_subscribers: {e}")
+            return {subscriber["EmailAddress"]: {"ok": False, "code": None, "message": str(e)}
+                    for subscriber in chunk}
+
+        self.__logger.info(
+            f"CampaignMonitor.import_subscribers: status_code: {r.status_code}")
+
+        if r.status_code == 201:
+            details = r.json().get("FailureDetails", [])
+        else:
+            try:
+                response = r.json()
+            except ValueError:
+                response = {}
+
+            # code 210 is a partial import, the failures are in ResultData
+            if response.get("Code") != 210:
+                return {subscriber["EmailAddress"]: {
+                    "ok": False, "code": response.get("Code"), "message": response.get("Message", r.text)
+                } for subscriber in chunk}
+
+            details = response.get("ResultData", {}).get("FailureDetails", [])
+
+        return {detail["EmailAddress"]: {
+            "ok": False, "code": detail.get("Code"), "message": detail.get("Message")
+        } for detail in details}
+
+
+class AsyncCampaignMonitor(AsyncWrapper):
+    """asyncio counterpart of CampaignMonitor, takes the same arguments
+
+    The blocking calls share the pooled transport of the sync class.
+    """
+
+    sync_class = CampaignMonitor
+    async_methods = ("add_subscriber_to_list", "import_subscribers")
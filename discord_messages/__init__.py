@@ -6,4 +6,5 @@ __title__ = 'discord_messages'
 __author__ = 'AdepDev'
 __version__ = '0.0.0'
 
-from .message import Message
+from .message import Message, AsyncMessage
+from .ratelimit import RateLimiter
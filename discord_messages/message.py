@@ -1,8 +1,17 @@
 import json
+import asyncio
 
-import requests
+from http_transport import AsyncWrapper, get_session
 
-__all__ = ('Message')
+from .ratelimit import RateLimiter
+
+__all__ = ('Message', 'AsyncMessage')
+
+# shared across every Message in the warm container so rate limit
+# state carries over between invocations
+_rate_limiter = RateLimiter()
+# channel_id -> newest message id seen by iter_messages(incremental=True)
+_last_seen = {}
 
 
 class Message:
@@ -35,7 +44,7 @@ class Message:
         """
 
         try:
-            r = requests.post(self.url, headers=self.headers, data=payload)
+            r = self.__request('POST', data=payload)
         except Exception as e:
             self.__logger.error(f"Message.post_message_to_channel: {e}")
             return {
@@ -51,7 +60,7 @@ class Message:
         """Get messages from a discord channel"""
 
         try:
-            r = requests.get(self.url, headers=self.headers)
+            r = self.__request('GET')
         except Exception as e:
             self.__logger.error(f"Message.get_messages_from_channel: {e}")
             return {
@@ -62,3 +71,123 @@ class Message:
         self.__logger.info(
             f"Message.post_message_to_channel: {r.text}")
         return r.json()
+
+    def iter_messages(self, before=None, after=None, limit=100, incremental=False, cursor_store=None):
+        """Lazily page through the history of the channel
+
+        Pages of `limit` messages are requested one at a time and paced by
+        the rate limiter, so the whole history is never held in memory.
+        args:
+            - before: Page backwards (newest to oldest) from this message ID
+            - after: Page forwards (oldest to newest) from this message ID
+            - limit: Messages per request, 100 is the Discord maximum
+            - incremental: Start after the last message seen on a previous run
+            - cursor_store: Optional object with get(channel_id)/put(channel_id, message_id)
+              used to remember the last seen message between cold starts.
+              Defaults to the warm container.
+        """
+        if incremental and after is None:
+            after = cursor_store.get(self.__CHANNEL_ID) if cursor_store else _last_seen.get(self.__CHANNEL_ID)
+
+        newest = None
+
+        while True:
+            params = {'limit': limit}
+            if after is not None:
+                params['after'] = after
+            elif before is not None:
+                params['before'] = before
+
+            r = self.__request('GET', params=params)
+
+            if not r.ok:
+                self.__logger.error(
+                    f"Message.iter_messages: status_code: {r.status_code} {r.text}")
+                return
+
+            page = r.json()
+            if not page:
+                break
+
+            ids = [int(message['id']) for message in page]
+            if newest is None or max(ids) > newest:
+                newest = max(ids)
+
+            # pages come back newest first, keep the order of travel
+            forward = after is not None
+            if forward:
+                page.reverse()
+                after = str(max(ids))
+            else:
+                before = str(min(ids))
+
+            yield from page
+
+            # only move the cursor once the caller has processed the whole
+            # page, so a failure mid-page is retried on the next run
+            if incremental and forward:
+                self.__save_cursor(cursor_store, after)
+
+            if len(page) < limit:
+                break
+
+        if incremental and newest is not None:
+            self.__save_cursor(cursor_store, str(newest))
+
+    def __save_cursor(self, cursor_store, message_id):
+        """Remember the newest message seen on the channel"""
+        if cursor_store:
+            cursor_store.put(self.__CHANNEL_ID, message_id)
+            return
+        _last_seen[self.__CHANNEL_ID] = message_id
+
+    def rate_limit_metrics(self):
+        """Counters for requests that were queued or delayed by the rate limiter"""
+        return dict(_rate_limiter.metrics)
+
+    def __request(self, method, max_retries=3, **kwargs):
+        """Send a request on the shared session, waiting out rate limits
+        args:
+            - method: The HTTP method
+            - max_retries: How many times a 429 is retried
+        """
+        route = f"{method} {self.url}"
+
+        for _ in range(max_retries + 1):
+            _rate_limiter.acquire(route)
+            # the rate limiter handles 429s, so no transport level retry
+            r = get_session(self.url, retry=False).request(
+                method, self.url, headers=self.headers, **kwargs)
+            retry_after = _rate_limiter.update(route, r)
+
+            if retry_after is None:
+                return r
+
+            self.__logger.info(
+                f"Message.request: {route} rate limited, retrying in {retry_after}s")
+
+        return r
+
+
+class AsyncMessage(AsyncWrapper):
+    """asyncio counterpart of Message, takes the same arguments
+
+    The blocking calls share the session and rate limiter of the sync class.
+    """
+
+    sync_class = Message
+    async_methods = ("post_message_to_channel", "get_messages_from_channel")
+
+    async def iter_messages(self, *args, **kwargs):
+        """Async generator over `Message.iter_messages`, takes the same arguments
+
+        Each step of the sync generator runs in the default executor, so the
+        event loop is never blocked on a page request or a rate limit wait.
+        """
+        messages = self.sync.iter_messages(*args, **kwargs)
+
+        while True:
+            message = await asyncio.to_thread(next, messages, None)
+            if message is None:
+                return
+            yield message
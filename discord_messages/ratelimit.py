@@ -0,0 +1,102 @@
+import time
+import threading
+
+__all__ = ('RateLimiter',)
+
+
+class RateLimiter:
+    """Tracks Discord's per-route rate limit buckets and the global limit.
+
+    Requests wait ahead of time when a bucket is exhausted instead of
+    running into a 429. Discord's headers are documented here:
+    https://discord.com/developers/docs/topics/rate-limits
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__routes = {}  # route -> bucket hash from X-RateLimit-Bucket
+        self.__buckets = {}  # bucket -> {'remaining': int, 'reset_at': float}
+        self.__global_reset_at = 0.0
+        self.metrics = {
+            'requests': 0,
+            'queued': 0,
+            'delayed_seconds': 0.0,
+            'rate_limited': 0,
+            'global_rate_limited': 0
+        }
+
+    def acquire(self, route):
+        """Block until a request on `route` can be sent without a 429.
+
+        args:
+            - route: The key for the route, ex: "POST /channels/123/messages"
+        """
+        queued = False
+
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                wait = self.__global_reset_at - now
+                bucket = self.__buckets.get(self.__routes.get(route, route))
+
+                if bucket is not None and bucket['reset_at'] > now:
+                    if bucket['remaining'] <= 0:
+                        wait = max(wait, bucket['reset_at'] - now)
+                    elif wait <= 0:
+                        # reserve our slot before the response comes back
+                        bucket['remaining'] -= 1
+
+                if wait <= 0:
+                    self.metrics['requests'] += 1
+                    return
+
+                if not queued:
+                    queued = True
+                    self.metrics['queued'] += 1
+                self.metrics['delayed_seconds'] += wait
+
+            time.sleep(wait)
+
+    def update(self, route, response):
+        """Record the rate limit headers of a response.
+
+        args:
+            - route: The key for the route the request was sent on
+            - response: The requests response
+        returns:
+            - The number of seconds to wait before retrying when the
+              response is a 429, otherwise None
+        """
+        headers = response.headers
+        now = time.monotonic()
+
+        with self.__lock:
+            bucket_id = headers.get('X-RateLimit-Bucket')
+
+            if bucket_id is not None:
+                self.__routes[route] = bucket_id
+
+            if 'X-RateLimit-Remaining' in headers and 'X-RateLimit-Reset-After' in headers:
+                self.__buckets[self.__routes.get(route, route)] = {
+                    'remaining': int(headers['X-RateLimit-Remaining']),
+                    'reset_at': now + float(headers['X-RateLimit-Reset-After'])
+                }
+
+            if response.status_code != 429:
+                return None
+
+            retry_after = float(headers.get('Retry-After', 1))
+            is_global = headers.get('X-RateLimit-Global', '').lower() == 'true'
+
+            self.metrics['rate_limited'] += 1
+
+            if is_global:
+                self.metrics['global_rate_limited'] += 1
+                self.__global_reset_at = now + retry_after
+            else:
+                self.__buckets[self.__routes.get(route, route)] = {
+                    'remaining': 0,
+                    'reset_at': now + retry_after
+                }
+
+        return retry_after
@@ -1,17 +1,41 @@
 import json
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 # 3rd party
-import requests
+from http_transport import AsyncWrapper, get_session
+
+try:
+    # orjson is several times faster, fall back to the stdlib without it
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
+
+# api_key -> deque of (regToken, expires_at), tokens fetched ahead of demand
+_token_pool = {}
+_token_lock = threading.Lock()
 
 
 class Epsilon:
     """An interface for handling request to the Eplison API"""
 
-    def __init__(self, logger, api_region, api_key):
+    def __init__(self, logger, api_region, api_key, token_ttl=3000, log_payloads=None):
         """_summary_
 
         Args:
             logger (obj): import logger object using the singleton pattern
             apikey (str): The api key for the Epsilon API
+            token_ttl (int): Seconds a pre-fetched registration token is used for.
+                Keep this under the lifetime of a regToken.
+            log_payloads (bool): Log the (PII heavy) params and responses at INFO level.
+                Defaults to logging them at DEBUG level, only when the logger is at DEBUG.
         """
 
         self.__logger = logger
@@ -22,15 +46,133 @@ class Epsilon:
         self.__data_param = None  # (obj) The data being sent as a paramenter
         # (obj) the profile being sent as a parameter
         self.__profile_param = None
+        self.token_ttl = token_ttl
+        self.__log_payloads = log_payloads
+        if log_payloads is None:
+            self.log_payloads = logger.isEnabledFor(logging.DEBUG)
+            self.__payload_log_level = logging.DEBUG
+        else:
+            self.log_payloads = log_payloads
+            self.__payload_log_level = logging.INFO
 
     def set_registration_token(self):
         """
         Start the Epsilon registration process by requesting a
         `registration_token` from the `accoutns.initRegiration` endpoint.
+
+        A token from the pre-fetched pool is used when one is still valid.
         """
 
         self.__logger.info('Epsilon.set_registration_token: start')
 
+        token = self.__take_pooled_token()
+        if token is not None:
+            self.__registration_token = token
+            self.__logger.info('Epsilon.set_registration_token: using pooled token')
+            return True
+
+        token = self.fetch_registration_token()
+        if token is None:
+            return False
+
+        self.__registration_token = token
+
+        self.__logger.info(
+            f'Epsilon.set_registration_token: token Set: {self.__registration_token}')
+
+        self.__logger.info('Epsilon.set_registration_token: Success')
+
+        return True
+
+    def prefetch_registration_tokens(self, count, max_workers=5):
+        """Fill the token pool ahead of a sign-up spike
+
+        Args:
+            count (int): The number of tokens to fetch
+            max_workers (int): The number of concurrent requests
+
+        Returns:
+            int: the number of tokens added to the pool
+        """
+
+        self.__logger.info(f'Epsilon.prefetch_registration_tokens: start - {count}')
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            tokens = [token for token in executor.map(
+                lambda _: self.fetch_registration_token(), range(count))
+                if token is not None]
+
+        expires_at = time.time() + self.token_ttl
+        with _token_lock:
+            pool = _token_pool.setdefault(self.__api_key, deque())
+            pool.extend((token, expires_at) for token in tokens)
+
+        self.__logger.info(
+            f'Epsilon.prefetch_registration_tokens: end - {len(tokens)} pooled')
+        return len(tokens)
+
+    def register_many(self, records, max_workers=5):
+        """Register a batch of users concurrently
+
+        Every record gets its own token (from the pool when available) and
+        registration, with at most `max_workers` running at once.
+
+        Args:
+            records (list): The payloads received from the lambda event
+
+        Returns:
+            list: one result per record, in order
+                Ex: [{"index": 0, "ok": True, "error": None}, ...]
+        """
+
+        self.__logger.info(f'Epsilon.register_many: start - {len(records)} records')
+
+        def register(indexed):
+            index, data = indexed
+            # the params and token live on the instance, so one per record
+            epsilon = Epsilon(self.__logger, self.api_region, self.__api_key,
+                              self.token_ttl, self.__log_payloads)
+
+            try:
+                if not epsilon.set_registration_token():
+                    return {"index": index, "ok": False, "error": "registration token"}
+                if not epsilon.post_registration(data):
+                    return {"index": index, "ok": False, "error": "registration"}
+            except Exception as e:
+                # ex: a record missing a field, the rest of the batch goes on
+                self.__logger.error(f'Epsilon.register_many: record {index}: {e}')
+                return {"index": index, "ok": False, "error": str(e)}
+
+            return {"index": index, "ok": True, "error": None}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(register, enumerate(records)))
+
+        failed = sum(1 for result in results if not result["ok"])
+        self.__logger.info(f'Epsilon.register_many: end - {failed} failed')
+        return results
+
+    def __take_pooled_token(self):
+        """Pop the oldest pooled token that has not expired"""
+
+        now = time.time()
+
+        with _token_lock:
+            pool = _token_pool.get(self.__api_key)
+            while pool:
+                token, expires_at = pool.popleft()
+                if expires_at > now:
+                    return token
+
+        return None
+
+    def fetch_registration_token(self):
+        """Request a new `regToken` from the `accounts.initRegistration` endpoint
+
+        Returns:
+            str: the token, or None if the request failed
+        """
+
         endpoint = f'{self.api_region}/accounts.initRegistration'
 
         params = {
@@ -39,46 +181,40 @@ class Epsilon:
         }
 
         try:
-            r = requests.post(endpoint, params=params)
+            r = get_session(endpoint).post(endpoint, params=params)
 
         except Exception as e:
             # critical lambda failture
-            self.__logger.error('Epsilon.set_registration_token: failed!!!')
+            self.__logger.error('Epsilon.fetch_registration_token: failed!!!')
             self.__logger.error(
-                f'Epsilon.set_registration_token: endpoint: {endpoint}')
+                f'Epsilon.fetch_registration_token: endpoint: {endpoint}')
             self.__logger.error(
-                f'Epsilon.set_registration_token: params: {params}')
-            self.__logger.error(f'Epsilon.set_registration_token: {e}')
+                f'Epsilon.fetch_registration_token: params: {params}')
+            self.__logger.error(f'Epsilon.fetch_registration_token: {e}')
 
-            return False
+            return None
 
         # if the request is 400 or greater,
         # return an error
         if not r.ok:
-            self.__logger.error('Epsilon.set_registration_token: failed!!!')
+            self.__logger.error('Epsilon.fetch_registration_token: failed!!!')
             self.__logger.error(
-                f'Epsilon.set_registration_token: endpoint: {endpoint}')
+                f'Epsilon.fetch_registration_token: endpoint: {endpoint}')
             self.__logger.error(
-                f'Epsilon.set_registration_token: params: {params}')
-            self.__logger.error(f'Epsilon.set_registration_token: {r.text}')
+                f'Epsilon.fetch_registration_token: params: {params}')
+            self.__logger.error(f'Epsilon.fetch_registration_token: {r.text}')
 
-            return False
-
-        self.__logger.info(
-            f'Epsilon.set_registration_token: response: \n{json.dumps(r.json(), indent=4)}')
+            return None
 
         # get the token from the response
         resp_dict = r.json()
 
-        # set the token
-        self.__registration_token = resp_dict["regToken"]
-
-        self.__logger.info(
-            f'Epsilon.set_registration_token: token Set: {self.__registration_token}')
-
-        self.__logger.info('Epsilon.set_registration_token: Success')
+        if self.log_payloads:
+            self.__logger.log(
+                self.__payload_log_level,
+                f'Epsilon.fetch_registration_token: response: \n{json.dumps(resp_dict, indent=4)}')
 
-        return True
+        return resp_dict["regToken"]
 
     def post_registration(self, data):
         """Try to send a POST to the `setAccountInfo`endpoint
@@ -102,7 +238,7 @@ class Epsilon:
         }
 
         try:
-            r = requests.post(endpoint, params=params)
+            r = get_session(endpoint).post(endpoint, params=params)
 
         except Exception as e:
             # critical lambda failture
@@ -127,8 +263,10 @@ class Epsilon:
 
             return False
 
-        self.__logger.info(
-            f'Epsilon.post_registration: response: \n{json.dumps(r.json(), indent=4)}')
+        if self.log_payloads:
+            self.__logger.log(
+                self.__payload_log_level,
+                f'Epsilon.post_registration: response: \n{json.dumps(r.json(), indent=4)}')
 
         self.__logger.info('Epsilon.post_registration: end')
 
@@ -155,10 +293,12 @@ class Epsilon:
         }
 
         # set the profile
-        self.__profile_param = json.dumps(profile)
+        self.__profile_param = _dumps(profile)
 
-        self.__logger.info(
-            f'Epsilon.build_profile_param: profile:\n{self.__profile_param}')
+        if self.log_payloads:
+            self.__logger.log(
+                self.__payload_log_level,
+                f'Epsilon.build_profile_param: profile:\n{self.__profile_param}')
 
         self.__logger.info('Epsilon.build_profile_param: end')
 
@@ -194,9 +334,21 @@ class Epsilon:
         }
 
         # set the profile
-        self.__data_param = json.dumps(event_data)
+        self.__data_param = _dumps(event_data)
 
-        self.__logger.info(
-            f'Epsilon.build_data_param: data:\n{self.__data_param}')
+        if self.log_payloads:
+            self.__logger.log(
+                self.__payload_log_level,
+                f'Epsilon.build_data_param: data:\n{self.__data_param}')
 
         self.__logger.info('Epsilon.build_data_param: end')
+
+
+class AsyncEpsilon(AsyncWrapper):
+    """asyncio counterpart of Epsilon, takes the same arguments
+
+    Parameter building and the token pool are shared with the wrapped Epsilon.
+    """
+
+    sync_class = Epsilon
+    async_methods = ("set_registration_token", "post_registration", "register_many")
@@ -0,0 +1,194 @@
+"""
+Pooled HTTP sessions shared by the REST integrations of this repo, and the
+base of their asyncio counterparts.
+
+The integrations import this module as `http_transport`, so it has to sit
+next to them on the python path: deploy http_transport.py in the root of the
+lambda package (or in a layer under /opt/python) together with the
+integration directory. Scripts run from inside an integration directory add
+the repo root to sys.path themselves.
+"""
+import time
+import asyncio
+import functools
+import threading
+from urllib.parse import urlsplit
+# 3rd party
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeout used when a request does not set its own
+DEFAULT_TIMEOUT = (3.05, 10)
+
+# Retried for idempotent methods only, a 502/504 can come back after the
+# server already processed the request. A 500 is never retried.
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Retried for every method, including POST: the server refused the request
+# without processing it.
+UNPROCESSED_STATUSES = (429, 503)
+
+# Methods that are safe to send twice
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"))
+
+# ("scheme://host", retry) -> requests.Session
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# host -> {"requests", "errors", "total_ms", "max_ms"}
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+class _TransportRetry(Retry):
+    """Only retries a non-idempotent request when it was never processed
+
+    Connection errors are retried for every method, read errors (ex: a read
+    timeout) never are, and a POST is only retried on 429/503.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if (method or "").upper() not in IDEMPOTENT_METHODS and status_code not in UNPROCESSED_STATUSES:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class _TransportAdapter(HTTPAdapter):
+    """An HTTPAdapter with a default timeout that records per-host metrics"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+
+        host = urlsplit(request.url).netloc
+        started = time.perf_counter()
+        error = False
+
+        try:
+            response = super().send(request, **kwargs)
+            error = response.status_code >= 400
+            return response
+        except Exception:
+            error = True
+            raise
+        finally:
+            _record(host, (time.perf_counter() - started) * 1000, error)
+
+
+def _record(host, elapsed_ms, error):
+    """Add one request to the counters of `host`"""
+
+    with _metrics_lock:
+        metrics = _metrics.setdefault(
+            host, {"requests": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0})
+        metrics["requests"] += 1
+        metrics["errors"] += int(error)
+        metrics["total_ms"] += elapsed_ms
+        metrics["max_ms"] = max(metrics["max_ms"], elapsed_ms)
+
+
+def get_session(url, retry=True, pool_maxsize=10):
+    """Get the pooled keep-alive session for the host of `url`
+
+    Requests on the session get DEFAULT_TIMEOUT unless they pass their own.
+    When `retry` is on, connection errors and 429/503 responses are retried
+    with exponential backoff, honoring `Retry-After`. Idempotent methods are
+    also retried on 502/504. Read errors are never retried, so a POST the
+    server may already have processed is not sent again and a request never
+    waits more than one read timeout.
+
+    Args:
+        url (str): Any url on the host, ex: the endpoint being called
+        retry (bool): Turn off for callers that handle rate limits themselves
+        pool_maxsize (int): The most connections kept open to the host
+
+    Returns:
+        requests.Session: the shared session
+    """
+
+    parts = urlsplit(url)
+    base = f"{parts.scheme}://{parts.netloc}"
+    key = (base, retry)
+
+    with _sessions_lock:
+        if key not in _sessions:
+            max_retries = _TransportRetry(
+                total=3,
+                read=0,
+                backoff_factor=0.5,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=None,
+                respect_retry_after_header=True,
+                raise_on_status=False) if retry else 0
+
+            session = requests.Session()
+            session.mount(base, _TransportAdapter(
+                pool_connections=1, pool_maxsize=pool_maxsize, max_retries=max_retries))
+            _sessions[key] = session
+
+        return _sessions[key]
+
+
+def metrics():
+    """Per-host request, error and latency counters for the container
+
+    Returns:
+        dict: host -> {"requests", "errors", "avg_ms", "max_ms"}
+    """
+
+    with _metrics_lock:
+        return {
+            host: {
+                "requests": m["requests"],
+                "errors": m["errors"],
+                "avg_ms": round(m["total_ms"] / m["requests"], 1),
+                "max_ms": round(m["max_ms"], 1),
+            }
+            for host, m in _metrics.items()
+        }
+
+
+class AsyncWrapper:
+    """Base of the asyncio counterparts of the integration classes
+
+    A subclass sets `sync_class` and lists the blocking methods in
+    `async_methods`. It takes the same arguments as `sync_class` and wraps an
+    instance of it in `self.sync`. The listed methods become coroutines that
+    run the sync method in the default executor, so calls to several
+    integrations can be awaited together with `asyncio.gather`. Everything
+    else is delegated to the wrapped instance.
+
+    Example:
+        class AsyncCampaignMonitor(AsyncWrapper):
+            sync_class = CampaignMonitor
+            async_methods = ("add_subscriber_to_list", "import_subscribers")
+    """
+
+    sync_class = None
+    async_methods = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls.async_methods:
+            setattr(cls, name, _to_thread(name, getattr(cls.sync_class, name)))
+
+    def __init__(self, *args, **kwargs):
+        self.sync = self.sync_class(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.sync, name)
+
+
+def _to_thread(name, func):
+    """Coroutine method running `self.sync.<name>` in the default executor"""
+
+    @functools.wraps(func)
+    async def method(self, *args, **kwargs):
+        return await asyncio.to_thread(getattr(self.sync, name), *args, **kwargs)
+
+    return method
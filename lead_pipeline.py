@@ -0,0 +1,219 @@
+import json
+import time
+import uuid
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class LeadPipeline:
+    """Dispatch one normalized lead to several vendor sinks in parallel
+
+    Each sink is a callable `func(lead, upstream)` where `upstream` holds the
+    results of the sinks it depends on. Sinks without dependencies start at
+    once, the others start as soon as their dependencies succeed.
+
+    Example:
+        pipeline = LeadPipeline(logger, retry_table="lead-retries")
+        pipeline.add_sink("dynamo", lambda lead, _: dynamo.dynamo_post(lead))
+        pipeline.add_sink("marketo_create", lambda lead, _: marketo.create_lead(lead))
+        pipeline.add_sink(
+            "marketo_list",
+            lambda lead, up: marketo.add_to_list(up["marketo_create"][0]["id"]),
+            depends_on=["marketo_create"])
+        pipeline.add_sink("campaign_monitor",
+                          lambda lead, _: cm.add_subscriber_to_list(json.dumps(lead)),
+                          timeout=5)
+        pipeline.add_sink("merkle",
+                          lambda lead, _: MerkleSftp(logger, "prod", lead).transfer_data(),
+                          timeout=30)
+        result = pipeline.run(lead)
+    """
+
+    def __init__(self, logger, retry_table=None):
+        """
+        Args:
+            logger (obj): import logger object using the singleton pattern
+            retry_table (str): Optional DynamoDB table failed sinks are written to,
+                it needs a string partition key named `id`
+        """
+        self.__logger = logger
+        self.sinks = {}
+        self.retry_store = None
+
+        if retry_table:
+            from aws.dynamo import Dynamo
+
+            self.retry_store = Dynamo(logger)
+            self.retry_store.set_table(retry_table)
+
+    def add_sink(self, name, func, depends_on=(), timeout=10):
+        """Register a vendor sink
+
+        Args:
+            name (str): A unique name for the sink
+            func (callable): `func(lead, upstream)`, returns the vendor response.
+                None, False or a dict with a statusCode of 400+ count as a failure.
+            depends_on (list): Sinks that must succeed before this one starts
+            timeout (float): Seconds to wait for the sink before giving up on it
+        """
+
+        for dependency in depends_on:
+            if dependency not in self.sinks:
+                raise ValueError(f"LeadPipeline.add_sink: unknown dependency {dependency}")
+
+        self.sinks[name] = {"func": func, "depends_on": tuple(depends_on), "timeout": timeout}
+
+    def run(self, lead):
+        """Send a lead to every sink
+
+        Args:
+            lead (dict): The normalized lead
+
+        Returns:
+            dict: the outcome and latency of every sink
+                Ex: {
+                    "ok": False,
+                    "total_ms": 812.4,
+                    "sinks": {
+                        "marketo_create": {"status": "ok", "latency_ms": 420.1, "error": None},
+                        "marketo_list": {"status": "ok", "latency_ms": 380.9, "error": None},
+                        "campaign_monitor": {"status": "timeout", "latency_ms": 5000.2, "error": "..."}
+                    }
+                }
+        """
+
+        self.__logger.info(f"LeadPipeline.run: start - {len(self.sinks)} sinks")
+
+        started = time.perf_counter()
+        report = {}
+        results = {}
+        running = {}  # future -> (name, started, deadline)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, len(self.sinks)))
+
+        try:
+            while True:
+                self.__start_ready(executor, lead, results, report, running)
+
+                if not running:
+                    break
+
+                now = time.perf_counter()
+                next_deadline = min(deadline for _, _, deadline in running.values())
+                done, _ = wait(list(running), timeout=max(0, next_deadline - now),
+                               return_when=FIRST_COMPLETED)
+
+                now = time.perf_counter()
+                for future in list(running):
+                    name, sink_started, deadline = running[future]
+
+                    if future in done:
+                        del running[future]
+                        latency_ms = (now - sink_started) * 1000
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            self.__finish(report, lead, name, "failed", latency_ms, e)
+                            continue
+
+                        if succeeded(result):
+                            results[name] = result
+                            self.__finish(report, lead, name, "ok", latency_ms)
+                        else:
+                            self.__finish(report, lead, name, "failed", latency_ms,
+                                          "no response" if result is None else result)
+
+                    elif now >= deadline:
+                        # the thread can't be stopped, we just stop waiting on it
+                        del running[future]
+                        self.__finish(report, lead, name, "timeout", (now - sink_started) * 1000,
+                                      f"no response after {self.sinks[name]['timeout']}s")
+
+        finally:
+            executor.shutdown(wait=False)
+
+        summary = {
+            "ok": all(sink["status"] == "ok" for sink in report.values()),
+            "total_ms": round((time.perf_counter() - started) * 1000, 1),
+            "sinks": report,
+        }
+
+        self.__save_failures(lead, report)
+
+        self.__logger.info(f"LeadPipeline.run: end - {summary}")
+        return summary
+
+    def __start_ready(self, executor, lead, results, report, running):
+        """Start every sink whose dependencies succeeded, skip those whose failed"""
+
+        started_names = {name for name, _, _ in running.values()}
+
+        for name, sink in self.sinks.items():
+            if name in report or name in started_names:
+                continue
+
+            if any(dependency in report and report[dependency]["status"] != "ok"
+                   for dependency in sink["depends_on"]):
+                self.__finish(report, lead, name, "skipped", 0.0, "a dependency failed")
+                continue
+
+            if all(dependency in results for dependency in sink["depends_on"]):
+                upstream = {dependency: results[dependency] for dependency in sink["depends_on"]}
+                now = time.perf_counter()
+                future = executor.submit(sink["func"], lead, upstream)
+                running[future] = (name, now, now + sink["timeout"])
+
+    def __finish(self, report, lead, name, status, latency_ms, error=None):
+        """Record the outcome of a sink"""
+
+        report[name] = {
+            "status": status,
+            "latency_ms": round(latency_ms, 1),
+            "error": None if error is None else str(error),
+        }
+
+        if status == "ok":
+            return
+
+        self.__logger.error(f"LeadPipeline.run: {name} {status}: {error}")
+
+    def __save_failures(self, lead, report):
+        """Write every sink that did not succeed to the retry table
+
+        Runs once every sink has finished, so the write never delays a
+        dependent sink.
+        """
+
+        if self.retry_store is None:
+            return
+
+        failures = [(name, sink) for name, sink in report.items() if sink["status"] != "ok"]
+        if not failures:
+            return
+
+        created = datetime.now(timezone.utc).isoformat()
+        body = json.dumps(lead, default=str)
+
+        self.retry_store.dynamo_batch_post([
+            {
+                "id": str(uuid.uuid4()),
+                "sink": name,
+                "status": sink["status"],
+                "error": sink["error"],
+                "lead": body,
+                "created": created,
+            }
+            for name, sink in failures
+        ])
+
+
+def succeeded(result):
+    """Whether a vendor response counts as a success"""
+
+    if result is None or result is False:
+        return False
+
+    if isinstance(result, dict) and result.get("statusCode", 200) >= 400:
+        return False
+
+    return True
@@ -0,0 +1,67 @@
+"""Compare the old f-string + re-parse payload path with InteractionTemplate
+
+Usage: python benchmark_payload.py [records]
+"""
+import sys
+import json
+import logging
+import os
+import timeit
+import xml.etree.ElementTree as ET
+
+META = {
+    "ExternalID": "1", "SourceCode": "SRC", "VendorCode": "VND", "ChannelCode": "W",
+    "ProductCode": "RK1", "CampaignCode": "CMP", "PromoCode": "PRM", "KitCode": "KIT",
+    "OfferCode": "OFR", "MediaOriginCode": "MED"
+}
+os.environ.setdefault("mrkle_meta", json.dumps(META))
+os.environ.setdefault("ftp_username_test", "user")
+os.environ.setdefault("ftp_password_test", "password")
+
+from merkle import MerkleSftp, CheckedXmlBuffer  # noqa: E402
+
+RECORD = {
+    "address": "1 Main St", "city": "Springfield", "email": "post@man.com",
+    "firstname": "Post", "lastname": "Man", "state": "NY", "zipcode": "99999",
+    "contact_type": "2", "has_prescription": True
+}
+DATE = "2023-02-07T13:29:14"
+
+
+def old_path(merkle, records):
+    """f-string interpolation, then ET.fromstring and serialize again"""
+    meta = merkle.meta
+    body = "".join(f"""<Interaction ExternalID="{meta['ExternalID']}" SourceCode="{meta['SourceCode']}" VendorCode="{meta['VendorCode']}" ChannelCode="{meta['ChannelCode']}" ProductCode="{meta['ProductCode']}">
+<Consumer AddressLine1="{data['address']}" CaptureDate="{DATE}" City="{data['city']}" EmailAddress="{data['email']}" FirstName="{data['firstname']}" LastName="{data['lastname']}" State="{data['state']}" ZipCodeBase="{data['zipcode']}"/>
+<Campaign CampaignCode="{meta['CampaignCode']}" PromoCode="{meta['PromoCode']}" KitCode="{meta['KitCode']}" OfferCode="{meta['OfferCode']}"/>
+<Response ResponseDate="{DATE}" MediaOriginCode="{meta['MediaOriginCode']}"/>
+	<Survey SurveyDate="{DATE}">
+			<Answers>
+				<Answer AnswerID="1" OpenEndedQuestionInd="N" QuestionID="9840"/>
+				<Answer AnswerID="{data['contact_type']}" OpenEndedQuestionInd="N" QuestionID="9841"/>
+				{merkle.build_xml_prop(data)}
+			</Answers>
+		</Survey>
+	</Interaction>
+""" for data in records)
+    payload = f'<?xml version="1.0" encoding="UTF-8"?>\n<Interactions>\n{body}</Interactions>\n'
+    return ET.tostring(ET.fromstring(payload))
+
+
+def new_path(merkle, records):
+    """compiled template streamed into a checked in-memory buffer"""
+    checked = CheckedXmlBuffer()
+    merkle.write_batch(checked, records)
+    return checked.close().getvalue()
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    logging.basicConfig(level=logging.WARNING)
+    merkle = MerkleSftp(logging.getLogger(), "test")
+    records = [RECORD] * count
+
+    for name, func in (("old", old_path), ("new", new_path)):
+        seconds = min(timeit.repeat(lambda: func(merkle, records), number=1, repeat=5))
+        print(f"{name}: {count} records in {seconds * 1000:.1f}ms "
+              f"({count / seconds:,.0f} records/s)")
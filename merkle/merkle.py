@@ -1,15 +1,226 @@
 from datetime import datetime
 import os
 import json
+import io
+import time
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import xml.etree.ElementTree as ET
+from xml.parsers import expat
+from xml.sax.saxutils import escape
 # 3rd party imports
 import paramiko
 
 
+class SftpConnection():
+    """Keeps an SFTP session open across warm lambda invocations
+
+    The SSH handshake and key exchange dominate the cost of a small upload,
+    so the transport is reused for as long as it stays healthy.
+    """
+
+    def __init__(self, host, username, password, port=22, keepalive=30, timeout=10):
+        """
+        Args:
+            host (str): The FTP host
+            username (str): The FTP username
+            password (str): The FTP password
+            port (int): The SSH port
+            keepalive (int): Seconds between keepalive packets on an idle transport
+            timeout (float): Seconds an SFTP request waits on the server before failing
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.transport = None
+        self.sftp = None
+        # timing of the last connect and transfer, in milliseconds
+        self.timings = {"handshake_ms": 0.0, "transfer_ms": 0.0}
+
+    def is_healthy(self):
+        """Check the transport is still usable before reusing it"""
+
+        if self.transport is None or not self.transport.is_active() or self.sftp is None:
+            return False
+
+        try:
+            # a request the server has to answer, a half open connection (ex:
+            # after a lambda freeze or a NAT idle timeout) fails it within the
+            # channel timeout
+            self.sftp.get_channel().settimeout(self.timeout)
+            self.sftp.stat(".")
+        except Exception:
+            return False
+
+        return True
+
+    def get_client(self):
+        """Return a live SFTPClient, reconnecting when needed"""
+
+        if self.is_healthy():
+            self.timings["handshake_ms"] = 0.0
+            return self.sftp
+
+        self.close()
+
+        started = time.perf_counter()
+        self.transport = paramiko.Transport((self.host, self.port))
+        self.transport.connect(None, self.username, self.password)
+        self.transport.set_keepalive(self.keepalive)
+        self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+        self.sftp.get_channel().settimeout(self.timeout)
+        self.timings["handshake_ms"] = (time.perf_counter() - started) * 1000
+
+        return self.sftp
+
+    def run(self, transfer):
+        """Run `transfer(sftp)` on a live client, reconnecting once on failure
+
+        Args:
+            transfer (callable): Receives the SFTPClient and performs the upload
+        """
+
+        for attempt in range(2):
+            sftp = self.get_client()
+            started = time.perf_counter()
+
+            try:
+                result = transfer(sftp)
+            except (EOFError, OSError, paramiko.SSHException):
+                # the server dropped a connection we thought was alive
+                self.close()
+                if attempt:
+                    raise
+                continue
+
+            self.timings["transfer_ms"] = (time.perf_counter() - started) * 1000
+            return result
+
+    def close(self):
+        """Close the client and transport, ignoring errors on dead connections"""
+
+        for conn in (self.sftp, self.transport):
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+        self.sftp = None
+        self.transport = None
+
+
+def _attr(value):
+    """Escape a value for use inside a double quoted XML attribute"""
+
+    return escape(str(value), {'"': "&quot;", "\n": "&#10;", "\t": "&#9;"})
+
+
+class InteractionTemplate():
+    """A compiled template for the `Interaction` element
+
+    The static `meta` attributes are escaped and rendered once, so each
+    record only escapes and fills in its own consumer fields.
+    """
+
+    def __init__(self, meta):
+        """
+        Args:
+            meta (dict): The Merkle meta data, see the `mrkle_meta` env var
+        """
+        # escape the meta values and protect braces from str.format
+        m = {key: _attr(value).replace("{", "{{").replace("}", "}}")
+             for key, value in meta.items()}
+
+        self.template = f"""<Interaction ExternalID="{m['ExternalID']}" SourceCode="{m['SourceCode']}" VendorCode="{m['VendorCode']}" ChannelCode="{m['ChannelCode']}" ProductCode="{m['ProductCode']}">
+<Consumer AddressLine1="{{address}}" CaptureDate="{{date}}" City="{{city}}" EmailAddress="{{email}}" FirstName="{{firstname}}" LastName="{{lastname}}" State="{{state}}" ZipCodeBase="{{zipcode}}"/>
+<Campaign CampaignCode="{m['CampaignCode']}" PromoCode="{m['PromoCode']}" KitCode="{m['KitCode']}" OfferCode="{m['OfferCode']}"/>
+<Response ResponseDate="{{date}}" MediaOriginCode="{m['MediaOriginCode']}"/>
+	<Survey SurveyDate="{{date}}">
+			<Answers>
+				<Answer AnswerID="1" OpenEndedQuestionInd="N" QuestionID="9840"/>
+				<Answer AnswerID="{{contact_type}}" OpenEndedQuestionInd="N" QuestionID="9841"/>
+				{{has_prescription}}
+			</Answers>
+		</Survey>
+	</Interaction>
+"""
+
+    def render(self, data, date_time_str, has_prescription):
+        """Render one escaped `Interaction` element
+
+        Args:
+            data (dict): The data we received from the POST
+            date_time_str (str): The capture timestamp, ex: 2023-02-07T13:29:14
+            has_prescription (str): The pre-built prescription `Answer` element
+        """
+
+        return self.template.format(
+            address=_attr(data['address']),
+            date=date_time_str,
+            city=_attr(data['city']),
+            email=_attr(data['email']),
+            firstname=_attr(data['firstname']),
+            lastname=_attr(data['lastname']),
+            state=_attr(data['state']),
+            zipcode=_attr(data['zipcode']),
+            contact_type=_attr(data['contact_type']),
+            has_prescription=has_prescription)
+
+
+# mrkle_meta env string -> InteractionTemplate
+_templates = {}
+
+
+def _get_template(meta_str):
+    """Get the compiled template for the `mrkle_meta` env var"""
+
+    if meta_str not in _templates:
+        _templates[meta_str] = InteractionTemplate(json.loads(meta_str))
+
+    return _templates[meta_str]
+
+
+class CheckedXmlBuffer():
+    """An in-memory file that checks the XML is well-formed as it is written
+
+    Every chunk is encoded once, fed to an expat parser and appended to the
+    buffer, so validation happens in the same pass as serialization.
+    """
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.__parser = expat.ParserCreate()
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        # raises expat.ExpatError on malformed XML
+        self.__parser.Parse(data, False)
+        self.buffer.write(data)
+
+    def close(self):
+        """Finish the document and rewind the buffer for uploading
+
+        Returns:
+            io.BytesIO: the serialized payload
+        """
+        self.__parser.Parse(b"", True)
+        self.buffer.seek(0)
+        return self.buffer
+
+
+# (host, username) -> SftpConnection
+_connections = {}
+
+
 class MerkleSftp():
     """This is an interface for the FPT with Merkle"""
 
-    def __init__(self, logger, stage, data):
+    def __init__(self, logger, stage, data=None):
         """
         Args:
             logger (obj): import logger object using the singleton pattern
@@ -17,17 +228,26 @@ class MerkleSftp():
                 Ex: 
                     - prod
                     - test
-            data (dict): The data we received from the POST
+            data (dict): The data we received from the POST. Leave empty
+                when submissions are queued with `queue_submission`.
         """
         self.stage = stage
         self.__logger = logger
         # get the meta data needed for the payload
         self.meta = json.loads(os.environ["mrkle_meta"])
+        self.template = _get_template(os.environ["mrkle_meta"])
         self.data = data
         self.ftp_username = None
         self.ftp_password = None
-        self.filename = self.set_filename()
-        self.payload_str = self.build_payload()
+        # keep a copy of every upload in /tmp, only meant for debugging
+        self.debug_tmp = os.environ.get("mrkle_debug_tmp", "false").lower() == "true"
+        self.filename = None
+        self.payload_str = None
+        # submissions waiting to be sent in a single batch file
+        self.queue = []
+        if data is not None:
+            self.filename = self.set_filename()
+            self.payload_str = self.build_payload()
         self.set_credentials()
 
     def set_credentials(self):
@@ -44,22 +264,28 @@ class MerkleSftp():
         self.ftp_username = os.environ["ftp_username_test"]
         self.ftp_password = os.environ["ftp_password_test"]
 
-    def build_xml_prop(self):
+    def build_xml_prop(self, data=None):
         """Builds the xml proerty for the open ended question has prescription
 
+        Args:
+            data (dict): The submission, defaults to `self.data`
+
         Note: The mapping for this data can be found in the Code Spec file provided by Merkle
         """
 
-        if int(self.data['contact_type']) == 2:
+        if data is None:
+            data = self.data
+
+        if int(data['contact_type']) == 2:
             # yes
-            if self.data["has_prescription"]:
+            if data["has_prescription"]:
                 return f'<Answer AnswerID="1" OpenEndedQuestionInd="N" QuestionID="9842"/>'
             # No
             return f'<Answer AnswerID="2" OpenEndedQuestionInd="N" QuestionID="9842"/>'
 
-        if int(self.data['contact_type']) == 3:
+        if int(data['contact_type']) == 3:
             # yes
-            if self.data["has_prescription"]:
+            if data["has_prescription"]:
                 return f'<Answer AnswerID="1" OpenEndedQuestionInd="N" QuestionID="9843"/>'
             # No
             return f'<Answer AnswerID="2" OpenEndedQuestionInd="N" QuestionID="9843"/>'
@@ -67,6 +293,19 @@ class MerkleSftp():
         # default return
         return ""
 
+    def build_interaction(self, data, date_time_str):
+        """Build a single `Interaction` element for a submission
+
+        User fields are XML escaped, so values like `&` or `<` are safe.
+
+        Args:
+            data (dict): The data we received from the POST
+            date_time_str (str): The capture timestamp, ex: 2023-02-07T13:29:14
+        """
+
+        return self.template.render(
+            data, date_time_str, self.build_xml_prop(data))
+
     def build_payload(self):
         """Build the payload that will be sent to the FTP"""
 
@@ -76,28 +315,43 @@ class MerkleSftp():
         now = datetime.now()
         date_time_str = now.strftime("%Y-%m-%dT%H:%M:%S")
 
-        has_prescription = self.build_xml_prop()
-
         payload = f"""<?xml version="1.0" encoding="UTF-8"?>
 <Interactions>
-<Interaction ExternalID="{self.meta['ExternalID']}" SourceCode="{self.meta['SourceCode']}" VendorCode="{self.meta['VendorCode']}" ChannelCode="{self.meta['ChannelCode']}" ProductCode="{self.meta['ProductCode']}">
-<Consumer AddressLine1="{self.data['address']}" CaptureDate="{date_time_str}" City="{self.data['city']}" EmailAddress="{self.data['email']}" FirstName="{self.data['firstname']}" LastName="{self.data['lastname']}" State="{self.data['state']}" ZipCodeBase="{self.data['zipcode']}"/>
-<Campaign CampaignCode="{self.meta['CampaignCode']}" PromoCode="{self.meta['PromoCode']}" KitCode="{self.meta['KitCode']}" OfferCode="{self.meta['OfferCode']}"/>
-<Response ResponseDate="{date_time_str}" MediaOriginCode="{self.meta['MediaOriginCode']}"/>
-	<Survey SurveyDate="{date_time_str}">
-			<Answers>
-				<Answer AnswerID="1" OpenEndedQuestionInd="N" QuestionID="9840"/>
-				<Answer AnswerID="{self.data['contact_type']}" OpenEndedQuestionInd="N" QuestionID="9841"/>
-				{has_prescription}
-			</Answers>
-		</Survey>
-	</Interaction>
-</Interactions>
+{self.build_interaction(self.data, date_time_str)}</Interactions>
 """
         self.__logger.info(f"MerkleSftp.build_payload: end:\n{payload}")
 
         return payload
 
+    def write_batch(self, file_obj, submissions):
+        """Stream a batch file with one `Interaction` per submission
+
+        Each interaction is written as soon as it is built, so the whole
+        document is never held in memory.
+
+        Args:
+            file_obj (obj): A text file object the XML is written to
+            submissions (iterable): The submissions (dicts) to write
+
+        Returns:
+            int: the number of records written
+        """
+
+        self.__logger.info("MerkleSftp.write_batch: start")
+
+        date_time_str = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        rec_count = 0
+
+        file_obj.write('<?xml version="1.0" encoding="UTF-8"?>\n<Interactions>\n')
+        for data in submissions:
+            file_obj.write(self.build_interaction(data, date_time_str))
+            rec_count += 1
+        file_obj.write('</Interactions>\n')
+
+        self.__logger.info(f"MerkleSftp.write_batch: end - {rec_count} records")
+
+        return rec_count
+
     def convert_to_xml(self):
         """Convert the xml sting to actualy XML"""
 
@@ -105,8 +359,12 @@ class MerkleSftp():
 
         return ET.fromstring(self.payload_str)
 
-    def set_filename(self):
-        """create the filename of the xml file"""
+    def set_filename(self, rec_count=1):
+        """create the filename of the xml file
+
+        Args:
+            rec_count (int): The number of records in the file
+        """
         # File naming instructions from Merkle
         #
         # <CLIENT_NAME>_<BRAND_CD*>_CNSMR_<CHANNEL**>_<ccyymmddhhmiss>_<rec_count>.xml
@@ -125,66 +383,247 @@ class MerkleSftp():
 
         self.__logger.info("MerkleSftp.set_filename: start")
 
-        filename = f"_{self.meta['ProductCode']}_CNSMR_W_{date_time_str}_4.xml"
+        filename = f"_{self.meta['ProductCode']}_CNSMR_W_{date_time_str}_{rec_count}.xml"
 
         self.__logger.info(
             f"MerkleSftp.set_filename: end - filename {filename}")
 
         return filename
 
-    def save_temp_payload_file(self):
-        """Save xml data to the tmp directory"""
+    def save_temp_payload_file(self, payload):
+        """Save xml data to the tmp directory, for debugging
 
-        self.__logger.info("MerkleSftp.save_temp_payload_file: start")
+        Args:
+            payload (bytes): The serialized XML file
+        """
 
-        # convert string to xml
-        xml_data = self.convert_to_xml()
+        self.__logger.info("MerkleSftp.save_temp_payload_file: start")
 
-        # save the file to the /tmp directory
-        xml_tree = ET.ElementTree(xml_data)
-        xml_tree.write(f"/tmp/{self.filename}")
+        with open(f"/tmp/{self.filename}", "wb") as f:
+            f.write(payload)
 
         self.__logger.info("MerkleSftp.save_temp_payload_file: end")
 
     def transfer_data(self):
         """Send data to the Merkle FTP
 
+        The payload is streamed to the server from memory, set the
+        `mrkle_debug_tmp` env var to also keep a copy in /tmp.
+
         docs: https://docs.paramiko.org/en/stable/index.html
+
+        Returns:
+            bool: True if the payload was uploaded
         """
 
         self.__logger.info("MerkleSftp.transfer_data: start")
 
-        # save the data as a file and the tmp directory
-        self.save_temp_payload_file()
+        try:
+            # serialize and check the payload in a single pass
+            checked = CheckedXmlBuffer()
+            checked.write(self.payload_str)
+            buffer = checked.close()
+
+            if self.debug_tmp:
+                self.save_temp_payload_file(buffer.getvalue())
+
+            self.upload(lambda sftp: self.__putfo(sftp, buffer))
+
+        except Exception as e:
+            self.__logger.error("MerkleSftp.transfer_data: Failed")
+            self.__logger.error(f"MerkleSftp.transfer_data: {e}")
+            return False
+
+        self.__logger.info("MerkleSftp.transfer_data: end")
+        return True
+
+    def __putfo(self, sftp, buffer):
+        """Upload an in-memory file to the Inbox, from the start of the buffer"""
 
-        # file Transfer Example...
-        # source: https://stackoverflow.com/questions/3635131/paramikos-sshclient-with-sftp
+        buffer.seek(0)
+        return sftp.putfo(buffer, f"/Inbox/{self.filename}")
 
-        # Create an sftp transport
-        self.__logger.info("MerkleSftp.transfer_data: Create a transport")
-        transport = paramiko.Transport((os.environ["ftp_host"], 22))
+    def queue_submission(self, data):
+        """Queue a submission to be sent with the next batch
 
-        # connect to server
-        self.__logger.info("MerkleSftp.transfer_data: connect to server")
-        transport.connect(None, self.ftp_username, self.ftp_password)
+        Args:
+            data (dict): The data we received from the POST
+        """
 
+        self.queue.append(data)
         self.__logger.info(
-            "MerkleSftp.transfer_data: Try creating an sftp client")
+            f"MerkleSftp.queue_submission: {len(self.queue)} queued")
+
+    def transfer_batch(self):
+        """Send every queued submission to the Merkle FTP as one XML file
+
+        A single SFTP connection is used for the whole batch.
+
+        Returns:
+            bool: True if the batch was uploaded
+        """
+
+        self.__logger.info("MerkleSftp.transfer_batch: start")
+
+        if not self.queue:
+            self.__logger.info("MerkleSftp.transfer_batch: nothing queued")
+            return True
+
+        self.filename = self.set_filename(rec_count=len(self.queue))
+
         try:
-            sftp = paramiko.SFTPClient.from_transport(transport)
-            self.__logger.info(sftp)
+            checked = CheckedXmlBuffer()
+            self.write_batch(checked, self.queue)
+            buffer = checked.close()
+
+            if self.debug_tmp:
+                self.save_temp_payload_file(buffer.getvalue())
+
+            self.upload(lambda sftp: self.__putfo(sftp, buffer))
+
+        except Exception as e:
+            self.__logger.error("MerkleSftp.transfer_batch: Failed")
+            self.__logger.error(f"MerkleSftp.transfer_batch: {e}")
+            return False
+
+        self.queue = []
+
+        self.__logger.info("MerkleSftp.transfer_batch: end")
+        return True
+
+    def get_connection(self):
+        """Get the shared SftpConnection for the current host and credentials"""
+
+        key = (os.environ["ftp_host"], self.ftp_username)
 
-            # create paths
-            localpath = f"/tmp/{self.filename}"
-            filepath = f"/Inbox/{self.filename}"
+        if key not in _connections:
+            _connections[key] = SftpConnection(
+                os.environ["ftp_host"], self.ftp_username, self.ftp_password)
 
-            sftp.put(localpath, filepath)
+        return _connections[key]
 
-            sftp.close()
-            transport.close()
+    def upload(self, transfer):
+        """Run an upload on the shared connection and log its timings
+
+        Args:
+            transfer (callable): Receives the SFTPClient and performs the upload
+        """
+
+        connection = self.get_connection()
+        result = connection.run(transfer)
+
+        self.__logger.info(
+            f"MerkleSftp.upload: handshake_ms: {connection.timings['handshake_ms']:.1f} "
+            f"transfer_ms: {connection.timings['transfer_ms']:.1f}")
+
+        return result
+
+    def transfer_files(self, local_paths, workers=4, transports=1, manifest_path="/tmp/merkle_manifest.json"):
+        """Upload many XML files to the Inbox concurrently, for backfills
+
+        Each worker opens its own SFTP channel over a small number of shared
+        transports. Files already in the Inbox with the same size, or recorded
+        in the manifest by an earlier run, are skipped so an interrupted run
+        resumes where it stopped.
+
+        Args:
+            local_paths (list): The xml files we're uploading
+            workers (int): The number of concurrent SFTP channels
+            transports (int): The number of SSH connections the channels share
+            manifest_path (str): A json file listing the files already uploaded
+
+        Returns:
+            dict: filename -> "uploaded", "skipped" or "failed: <error>"
+        """
+
+        self.__logger.info(
+            f"MerkleSftp.transfer_files: start - {len(local_paths)} files")
+
+        host = os.environ["ftp_host"]
+        connections = [SftpConnection(host, self.ftp_username, self.ftp_password)
+                       for _ in range(max(1, transports))]
+        results = {}
+
+        try:
+            remote_sizes = {
+                attr.filename: attr.st_size
+                for attr in connections[0].get_client().listdir_attr("/Inbox")
+            }
+            manifest = _load_manifest(manifest_path)
+
+            pending = []
+            for path in local_paths:
+                name = os.path.basename(path)
+                if name in manifest or remote_sizes.get(name) == os.path.getsize(path):
+                    results[name] = "skipped"
+                else:
+                    pending.append(path)
+
+            self.__logger.info(
+                f"MerkleSftp.transfer_files: {len(pending)} to upload, "
+                f"{len(results)} skipped")
+
+            for conn in connections[1:]:
+                conn.get_client()
+
+            local = threading.local()
+            lock = threading.Lock()
+            counter = itertools.count()
+
+            def upload(path):
+                name = os.path.basename(path)
+
+                try:
+                    # one channel per worker thread, spread across the transports
+                    if not hasattr(local, "sftp"):
+                        with lock:
+                            conn = connections[next(counter) % len(connections)]
+                        local.sftp = paramiko.SFTPClient.from_transport(conn.transport)
+                        local.sftp.get_channel().settimeout(conn.timeout)
+
+                    local.sftp.put(path, f"/Inbox/{name}")
+                except Exception as e:
+                    self.__logger.error(f"MerkleSftp.transfer_files: {name}: {e}")
+                    return name, f"failed: {e}"
+
+                with lock:
+                    manifest.add(name)
+                    _save_manifest(manifest_path, manifest)
+
+                return name, "uploaded"
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results.update(executor.map(upload, pending))
 
         except Exception as e:
-            self.__logger.error("MerkleSftp.transfer_data: Failed")
-            self.__logger.error(f"MerkleSftp.transfer_data: {e}")
+            self.__logger.error("MerkleSftp.transfer_files: Failed")
+            self.__logger.error(f"MerkleSftp.transfer_files: {e}")
+            # report every file that was never attempted
+            for path in local_paths:
+                results.setdefault(os.path.basename(path), f"failed: {e}")
 
-        self.__logger.info("MerkleSftp.transfer_data: end")
+        finally:
+            for conn in connections:
+                conn.close()
+
+        self.__logger.info("MerkleSftp.transfer_files: end")
+        return results
+
+
+def _load_manifest(manifest_path):
+    """Read the set of filenames already uploaded by a previous run"""
+
+    if not os.path.exists(manifest_path):
+        return set()
+
+    with open(manifest_path) as f:
+        return set(json.load(f))
+
+
+def _save_manifest(manifest_path, manifest):
+    """Write the manifest atomically so a crash never leaves it half written"""
+
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(sorted(manifest), f)
+    os.replace(tmp_path, manifest_path)
@@ -1,17 +1,50 @@
 import os
+import queue
+import threading
 # 3rd party
-import requests
+from http_transport import AsyncWrapper, get_session
+
+# (endpoint, headers, payload, timeout, logger, done) posted by the background
+# worker, which sets the `done` threading.Event once the post has finished
+_outbox = queue.Queue()
+_worker = None
+
+
+def _send_worker():
+    """Post queued notifications in the background so the handler never waits"""
+
+    while True:
+        endpoint, headers, payload, timeout, logger, done = _outbox.get()
+
+        try:
+            get_session(endpoint, retry=False).post(
+                endpoint, headers=headers, json=payload, timeout=timeout)
+        except Exception as e:
+            logger.error(f"Notifications.flush: failed!!! {e}")
+        finally:
+            done.set()
+
+
+def _start_worker():
+    """Start the background worker once per container"""
+
+    global _worker
+
+    if _worker is None or not _worker.is_alive():
+        _worker = threading.Thread(target=_send_worker, daemon=True)
+        _worker.start()
 
 
 class Notifications():
     """This class sends notifications the RH api which are then passed to Ms Teams"""
 
-    def __init__(self, endpoint, logger, event):
+    def __init__(self, endpoint, logger, event, timeout=(1, 2)):
         """
         Args:
             endpoint (_type_): The API endpoint we're posting notificaitons too
             logger (obj): import logger object using the singleton pattern
             event (json): Event data that has trigged the lambda function
+            timeout (tuple): The (connect, read) timeout for posting a notification
         """
 
         # private vars
@@ -19,6 +52,13 @@ class Notifications():
         self.__event = event
         self.endpoint = endpoint
         self.payload = None
+        self.timeout = timeout
+        # payloads waiting for flush(), an instance lives for one invocation
+        self.pending = []
+        self.__pending_lock = threading.Lock()
+        self.headers = {
+            "contentType": "application/json"
+        }
 
     def send_notification(self, failed_function_name, description):
         """Send a POST request to the RH API
@@ -30,15 +70,12 @@ class Notifications():
 
         self.__logger.info("Notifications.send_notification: start")
 
-        headers = {
-            "contentType": "application/json"
-        }
-
         self.set_payload(failed_function_name, description)
 
         try:
-            r = requests.post(self.endpoint, headers=headers,
-                              json=self.payload)
+            # strict timeout budget, so no transport level retries
+            r = get_session(self.endpoint, retry=False).post(
+                self.endpoint, headers=self.headers, json=self.payload, timeout=self.timeout)
 
         except Exception as e:
             self.__logger.error("Notifications.send_notification: failed!!!")
@@ -77,3 +114,73 @@ class Notifications():
             self.payload["origin"] = self.__event["headers"]["origin"]
 
         self.__logger.info("Notifications.set_payload: end")
+
+    def queue_notification(self, failed_function_name, description):
+        """Queue a notification to be sent by `flush` at the end of the invocation
+
+        Args:
+            function_name (str): The name of the fucntion that failed within lambda
+            description (str): A scrption of the potentail problem
+        """
+
+        self.set_payload(failed_function_name, description)
+
+        with self.__pending_lock:
+            self.pending.append(self.payload)
+
+        self.__logger.info(
+            f"Notifications.queue_notification: {len(self.pending)} queued")
+
+    def flush(self, wait=None):
+        """Send every queued notification as a single request, in the background
+
+        Call this at the end of the handler. The failures are merged into one
+        payload and posted by a worker thread. Only the notifications queued on
+        this instance are sent, to this instance's endpoint.
+
+        The container freezes as soon as the handler returns, so by default
+        flush blocks until this post has finished, at most the connect + read
+        timeout. `wait=0` is the only mode that returns without waiting, the
+        post may then be cut off by the freeze.
+
+        Args:
+            wait (float): The most seconds to wait for the post, 0 to not wait.
+                Defaults to the connect + read timeout.
+        """
+
+        with self.__pending_lock:
+            payloads = self.pending[:]
+            self.pending.clear()
+
+        if not payloads:
+            return
+
+        self.__logger.info(
+            f"Notifications.flush: sending {len(payloads)} notifications")
+
+        payload = dict(payloads[0])
+        if len(payloads) > 1:
+            payload["function_name"] = ", ".join(
+                p["function_name"] for p in payloads)
+            payload["description"] = "\n".join(
+                f'{p["function_name"]}: {p["description"]}' for p in payloads)
+
+        done = threading.Event()
+        _start_worker()
+        _outbox.put((self.endpoint, self.headers, payload, self.timeout, self.__logger, done))
+
+        if wait is None:
+            wait = sum(self.timeout) if isinstance(self.timeout, tuple) else self.timeout
+
+        if wait > 0:
+            done.wait(wait)
+
+
+class AsyncNotifications(AsyncWrapper):
+    """asyncio counterpart of Notifications, takes the same arguments
+
+    The payload is built by the wrapped Notifications.
+    """
+
+    sync_class = Notifications
+    async_methods = ("send_notification",)
@@ -0,0 +1,229 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from lead_pipeline import succeeded
+
+# The most personalizations SendGrid accepts in a single request
+SENDGRID_BATCH_SIZE = 1000
+
+
+class SqsBatchAdapter:
+    """Process a whole SQS event batch with the integration classes
+
+    Records are grouped by destination. Destinations with a batch handler get
+    all of their records in one call (Dynamo batch writes, Marketo multi-lead
+    upsert, Campaign Monitor import, SendGrid personalizations), the rest go
+    through a bounded thread pool one record at a time. Only the records that
+    failed are reported back, so SQS retries just those.
+
+    docs: https://docs.aws.amazon.com/lambda/latest/dg/with-sqs.html#services-sqs-batchfailurereporting
+
+    Each record body is json: {"destination": "marketo", "data": {...}}
+
+    Example:
+        adapter = SqsBatchAdapter(logger)
+        adapter.register_batch("dynamo", dynamo_batch_handler(dynamo))
+        adapter.register_batch("marketo", marketo_batch_handler(marketo))
+        adapter.register("epsilon", lambda data: register_with_epsilon(data))
+
+        def lambda_handler(event, context):
+            return adapter.handle(event)
+    """
+
+    def __init__(self, logger, max_workers=10):
+        """
+        Args:
+            logger (obj): import logger object using the singleton pattern
+            max_workers (int): The most per-record handlers running at once
+        """
+        self.__logger = logger
+        self.max_workers = max_workers
+        self.handlers = {}
+        self.batch_handlers = {}
+
+    def register(self, destination, func):
+        """Handle records for `destination` one at a time
+
+        Args:
+            destination (str): The destination named in the record body
+            func (callable): `func(data)`, None, False or a dict with a
+                statusCode of 400+ count as a failure
+        """
+        self.handlers[destination] = func
+
+    def register_batch(self, destination, func):
+        """Handle every record for `destination` in a single call
+
+        Args:
+            destination (str): The destination named in the record body
+            func (callable): `func(records)` where records is a list of
+                (message_id, data), returns the set of message ids that failed
+        """
+        self.batch_handlers[destination] = func
+
+    def handle(self, event):
+        """Process an SQS event
+
+        Args:
+            event (dict): The event the lambda was invoked with
+
+        Returns:
+            dict: {"batchItemFailures": [{"itemIdentifier": "message id"}, ...]}
+        """
+
+        records = event.get("Records", [])
+        self.__logger.info(f"SqsBatchAdapter.handle: start - {len(records)} records")
+
+        failed = set()
+        groups = {}
+
+        for record in records:
+            message_id = record["messageId"]
+            try:
+                body = json.loads(record["body"])
+                groups.setdefault(body["destination"], []).append((message_id, body["data"]))
+            except Exception as e:
+                self.__logger.error(f"SqsBatchAdapter.handle: {message_id}: bad record: {e}")
+                failed.add(message_id)
+
+        singles = []
+
+        for destination, group in groups.items():
+            if destination in self.batch_handlers:
+                failed |= self.__run_batch(destination, group)
+            elif destination in self.handlers:
+                singles.extend((destination, message_id, data) for message_id, data in group)
+            else:
+                self.__logger.error(f"SqsBatchAdapter.handle: no handler for {destination}")
+                failed |= {message_id for message_id, _ in group}
+
+        if singles:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for message_id, ok in executor.map(lambda single: self.__run_single(*single), singles):
+                    if not ok:
+                        failed.add(message_id)
+
+        self.__logger.info(f"SqsBatchAdapter.handle: end - {len(failed)} failed")
+
+        # keep the order SQS sent the records in
+        return {
+            "batchItemFailures": [
+                {"itemIdentifier": record["messageId"]}
+                for record in records if record["messageId"] in failed
+            ]
+        }
+
+    def __run_batch(self, destination, group):
+        """Run a batch handler, failing the whole group if it raises"""
+
+        try:
+            return set(self.batch_handlers[destination](group))
+        except Exception as e:
+            self.__logger.error(f"SqsBatchAdapter.handle: {destination}: {e}")
+            return {message_id for message_id, _ in group}
+
+    def __run_single(self, destination, message_id, data):
+        """Run a per-record handler, returns (message_id, ok)"""
+
+        try:
+            return message_id, succeeded(self.handlers[destination](data))
+        except Exception as e:
+            self.__logger.error(f"SqsBatchAdapter.handle: {destination}: {message_id}: {e}")
+            return message_id, False
+
+
+def dynamo_batch_handler(dynamo):
+    """Batch handler writing every record with `Dynamo.dynamo_batch_post`
+
+    Args:
+        dynamo (obj): A Dynamo with its table set
+    """
+
+    def handle(records):
+        result = dynamo.dynamo_batch_post([data for _, data in records])
+        return set() if succeeded(result) else {message_id for message_id, _ in records}
+
+    return handle
+
+
+def marketo_batch_handler(marketo, add_to_list=False):
+    """Batch handler upserting every record with `Marketo.create_leads`
+
+    Skipped leads (ex: already exists) count as processed, only leads
+    that failed are retried.
+
+    Args:
+        marketo (obj): A Marketo
+        add_to_list (bool): Also add the created leads to the Marketo list
+    """
+
+    def handle(records):
+        leads = [data for _, data in records]
+        if add_to_list:
+            results = marketo.create_leads_and_add_to_list(leads)
+        else:
+            results = marketo.create_leads(leads)
+
+        return {message_id for (message_id, _), result in zip(records, results)
+                if result.get("status") == "failed" or result.get("list_status") == "failed"}
+
+    return handle
+
+
+def campaign_monitor_batch_handler(campaign_monitor):
+    """Batch handler importing every record with `CampaignMonitor.import_subscribers`
+
+    Args:
+        campaign_monitor (obj): A CampaignMonitor
+    """
+
+    def handle(records):
+        # a record without an address fails on its own, the rest are still imported
+        valid = [(message_id, data) for message_id, data in records
+                 if isinstance(data, dict) and data.get("EmailAddress")]
+        failed = {message_id for message_id, _ in records} - {message_id for message_id, _ in valid}
+
+        if valid:
+            results = campaign_monitor.import_subscribers([data for _, data in valid])
+            failed |= {message_id for message_id, data in valid
+                       if not results.get(data["EmailAddress"], {}).get("ok")}
+
+        return failed
+
+    return handle
+
+
+def sendgrid_batch_handler(sendgrid):
+    """Batch handler sending every record with `SendGrid.send_to_many`
+
+    Records with the same subject and body are sent in one request, one
+    personalization per recipient. The data of a record is
+    {"to_email": "...", "subject": "...", "message_body": "..."}.
+
+    Args:
+        sendgrid (obj): A SendGrid
+    """
+
+    def handle(records):
+        failed = set()
+        emails = {}
+
+        for message_id, data in records:
+            try:
+                emails.setdefault((data["subject"], data["message_body"]), []).append(
+                    (message_id, data["to_email"]))
+            except (KeyError, TypeError):
+                # a malformed record fails on its own, the rest are still sent
+                failed.add(message_id)
+
+        for (subject, message_body), recipients in emails.items():
+            for i in range(0, len(recipients), SENDGRID_BATCH_SIZE):
+                chunk = recipients[i:i + SENDGRID_BATCH_SIZE]
+                result = sendgrid.send_to_many(
+                    subject, message_body, [email for _, email in chunk])
+                if not succeeded(result):
+                    failed |= {message_id for message_id, _ in chunk}
+
+        return failed
+
+    return handle
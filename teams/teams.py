@@ -1,5 +1,212 @@
 import json
-import requests
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http_transport import AsyncWrapper, get_session
+
+
+_HEADERS = {
+    "Content-type": "application/json",
+}
+
+# The static parts of the MessageCard are built once at import time,
+# build_payload only fills in the variable facts.
+_CARD_TEMPLATE = {
+    "@type": "MessageCard",
+    "summary": "Lambda Failure!!!",
+}
+
+_SECTION_TEMPLATE = {
+    "activityImage": "https://cdn3.vectorstock.com/i/1000x1000/02/52/pirate-skull-icon-vector-11230252.jpg",
+    "markdown": True,
+}
+
+# (fact name, key in the event data)
+_FACTS = (
+    ("Description", "description"),
+    ("Origin", "origin"),
+    ("Api Domain Name", "api_domain_name"),
+    ("Api Path", "api_path"),
+    ("Api Method", "api_method"),
+    ("Status", "status"),
+    ("Log Stream", "log_stream"),
+)
+
+# Coalescing state of MemoryAlertStore, keyed on
+# lambda_name/function_name/status
+_alert_state = {}
+_alert_state_lock = threading.Lock()
+
+
+class MemoryAlertStore:
+    """Keeps alert coalescing state in the lambda container
+
+    A window is open while its `window_start` is after the cutoff passed in,
+    ex: now - window_seconds.
+    """
+
+    def count(self, key, now, cutoff):
+        """Count a duplicate in the open window, returns the new count or None if no window is open"""
+        with _alert_state_lock:
+            state = _alert_state.get(key)
+            if state is None or state["window_start"] <= cutoff:
+                return None
+            state["count"] += 1
+            state["last_seen"] = now
+            return state["count"]
+
+    def open_window(self, key, state, cutoff):
+        """Start a new window unless one is open, returns (opened, previous state)"""
+        with _alert_state_lock:
+            previous = _alert_state.get(key)
+            if previous is not None and previous["window_start"] > cutoff:
+                return False, None
+            _alert_state[key] = state
+            return True, previous
+
+    def close_window(self, key, window_start, previous):
+        """Put back the previous state of a window whose alert could not be sent"""
+        with _alert_state_lock:
+            state = _alert_state.get(key)
+            if state is None or state["window_start"] != window_start:
+                return
+            if previous is None:
+                del _alert_state[key]
+            else:
+                _alert_state[key] = previous
+
+    def set_flushed(self, key, window_start, flushed):
+        """Mark the summary of a window as sent, returns False if it already was"""
+        with _alert_state_lock:
+            state = _alert_state.get(key)
+            if (state is None or state["window_start"] != window_start
+                    or state["flushed"] == flushed):
+                return False
+            state["flushed"] = flushed
+            return True
+
+    def items(self):
+        with _alert_state_lock:
+            return [(key, dict(state)) for key, state in _alert_state.items()]
+
+
+class DynamoAlertStore:
+    """Keeps alert coalescing state in DynamoDB so it is shared across containers
+
+    Every change is a conditional write, so when several containers see the
+    same alert only one of them opens the window and sends it, and every
+    duplicate is counted.
+
+    The table needs a string partition key named `alert_key`. Enable TTL on the
+    `expires_at` attribute to have stale windows cleaned up automatically.
+    """
+
+    def __init__(self, logger, table_name):
+        """
+        Args:
+            logger (obj): import logger object using the singleton pattern
+            table_name (str): The DynamoDB table the state is stored in
+        """
+        from aws.dynamo import Dynamo
+
+        self.dynamo = Dynamo(logger)
+        self.dynamo.set_table(table_name)
+        self.table = self.dynamo.table
+        self.__conditional_failed = self.table.meta.client.exceptions.ConditionalCheckFailedException
+
+    def count(self, key, now, cutoff):
+        """Count a duplicate in the open window, returns the new count or None if no window is open"""
+        try:
+            response = self.table.update_item(
+                Key={"alert_key": key},
+                UpdateExpression="ADD #count :one SET last_seen = :now, expires_at = :expires_at",
+                ConditionExpression="window_start > :cutoff",
+                ExpressionAttributeNames={"#count": "count"},
+                ExpressionAttributeValues={
+                    ":one": 1, ":now": now, ":cutoff": cutoff, ":expires_at": now + 86400},
+                ReturnValues="UPDATED_NEW")
+        except self.__conditional_failed:
+            return None
+
+        return int(response["Attributes"]["count"])
+
+    def open_window(self, key, state, cutoff):
+        """Start a new window unless one is open, returns (opened, previous state)"""
+        try:
+            response = self.table.put_item(
+                Item=self.__to_item(key, state),
+                ConditionExpression="attribute_not_exists(alert_key) OR window_start <= :cutoff",
+                ExpressionAttributeValues={":cutoff": cutoff},
+                ReturnValues="ALL_OLD")
+        except self.__conditional_failed:
+            return False, None
+
+        previous = response.get("Attributes")
+        return True, None if previous is None else self.__to_state(previous)
+
+    def close_window(self, key, window_start, previous):
+        """Put back the previous state of a window whose alert could not be sent"""
+        condition = {
+            "ConditionExpression": "window_start = :window_start",
+            "ExpressionAttributeValues": {":window_start": window_start},
+        }
+
+        try:
+            if previous is None:
+                self.table.delete_item(Key={"alert_key": key}, **condition)
+            else:
+                self.table.put_item(Item=self.__to_item(key, previous), **condition)
+        except self.__conditional_failed:
+            # another container already opened a newer window
+            pass
+
+    def set_flushed(self, key, window_start, flushed):
+        """Mark the summary of a window as sent, returns False if it already was"""
+        try:
+            self.table.update_item(
+                Key={"alert_key": key},
+                UpdateExpression="SET flushed = :flushed",
+                ConditionExpression="window_start = :window_start AND flushed <> :flushed",
+                ExpressionAttributeValues={":flushed": flushed, ":window_start": window_start})
+        except self.__conditional_failed:
+            return False
+
+        return True
+
+    def items(self):
+        """Every (key, state) pair in the table"""
+        items = []
+        kwargs = {}
+
+        while True:
+            response = self.table.scan(**kwargs)
+            items.extend((item["alert_key"], self.__to_state(item))
+                         for item in response.get("Items", []))
+
+            if "LastEvaluatedKey" not in response:
+                return items
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def __to_item(self, key, state):
+        return {
+            "alert_key": key,
+            **state,
+            # keep the item around for a day after the last occurrence
+            "expires_at": state["last_seen"] + 86400,
+        }
+
+    def __to_state(self, item):
+        """Convert the DynamoDB Decimals back to ints"""
+        return {
+            "window_start": int(item["window_start"]),
+            "first_seen": int(item["first_seen"]),
+            "last_seen": int(item["last_seen"]),
+            "count": int(item["count"]),
+            "flushed": bool(item.get("flushed", False)),
+            "data": item["data"],
+            "webhook_url": item["webhook_url"],
+        }
 
 
 class MsTeams:
@@ -28,43 +235,16 @@ class MsTeams:
 
         try:
             self.__payload = {
-                "@type": "MessageCard",
-                "summary": "Lambda Failure!!!",
+                **_CARD_TEMPLATE,
                 "sections": [
                     {
+                        **_SECTION_TEMPLATE,
                         "activityTitle": f'Lambda Name: {data["lambda_name"]}',
                         "activitySubtitle": f'Failing Function Name: {data["function_name"]}',
-                        "activityImage": "https://cdn3.vectorstock.com/i/1000x1000/02/52/pirate-skull-icon-vector-11230252.jpg",
                         "facts": [
-                            {
-                                "name": "Description",
-                                "value": data["description"]
-                            },
-                            {
-                                "name": "Origin",
-                                "value": data["origin"]
-                            },
-                            {
-                                "name": "Api Domain Name",
-                                "value": data["api_domain_name"]
-                            },
-                            {
-                                "name": "Api Path",
-                                "value": data["api_path"]
-                            },
-                            {
-                                "name": "Api Method",
-                                "value": data["api_method"]
-                            },
-                            {
-                                "name": "Status",
-                                "value": data["status"]
-                            },
-                            {
-                                "name": "Log Stream",
-                                "value": data["log_stream"]
-                            }
-                        ], "markdown": True
+                            {"name": name, "value": data[key]}
+                            for name, key in _FACTS
+                        ]
                     }]
             }
 
@@ -85,13 +265,9 @@ class MsTeams:
 
         self.__logger.info("MsTeams.send_webhook_message_to_channel: start")
 
-        headers = {
-            "Content-type": "application/json",
-        }
-
         try:
-            r = requests.post(webhook_url, headers=headers,
-                              json=self.__payload)
+            r = get_session(webhook_url).post(
+                webhook_url, headers=_HEADERS, json=self.__payload)
         except Exception as e:
             self.__logger.error(
                 "MsTeams.send_webhook_message_to_channel: Failed!!!")
@@ -111,3 +287,255 @@ class MsTeams:
 
         self.__logger.info("MsTeams.send_webhook_message_to_channel: end")
         return True
+
+    def broadcast(self, webhook_urls, timeout=(3.05, 10), max_retries=2):
+        """Send the current payload to several channels at once
+
+        The payload is serialized a single time and posted to every url
+        concurrently, so the total latency is that of the slowest webhook.
+        A 429 from Teams is retried after the `Retry-After` delay.
+
+        Args:
+            webhook_urls (list): The webhook urls of the teams channels
+            timeout (tuple|float): The (connect, read) timeout for each post
+            max_retries (int): How many times a throttled post is retried
+
+        Returns:
+            dict: per url results
+                Ex: {"https://...": {"ok": True, "status_code": 200, "attempts": 1, "error": None}}
+        """
+
+        self.__logger.info(f"MsTeams.broadcast: start - {len(webhook_urls)} urls")
+
+        body = json.dumps(self.__payload).encode("utf-8")
+
+        with ThreadPoolExecutor(max_workers=max(1, len(webhook_urls))) as executor:
+            results = dict(zip(webhook_urls, executor.map(
+                lambda url: self.__post_with_retry(url, body, timeout, max_retries),
+                webhook_urls)))
+
+        failed = [url for url, result in results.items() if not result["ok"]]
+        if failed:
+            self.__logger.error(f"MsTeams.broadcast: Failed!!! {len(failed)} urls")
+
+        self.__logger.info("MsTeams.broadcast: end")
+        return results
+
+    def __post_with_retry(self, webhook_url, body, timeout, max_retries):
+        """Post an already serialized payload, retrying on 429"""
+
+        result = {"ok": False, "status_code": None, "attempts": 0, "error": None}
+
+        while result["attempts"] <= max_retries:
+            result["attempts"] += 1
+
+            try:
+                # broadcast handles 429s itself, so no transport level retry
+                r = get_session(webhook_url, retry=False).post(
+                    webhook_url, headers=_HEADERS, data=body, timeout=timeout)
+            except Exception as e:
+                self.__logger.error(f"MsTeams.broadcast: {webhook_url}: {e}")
+                result["error"] = str(e)
+                return result
+
+            result["status_code"] = r.status_code
+
+            if r.status_code == 429 and result["attempts"] <= max_retries:
+                delay = _retry_after(r)
+                self.__logger.info(
+                    f"MsTeams.broadcast: {webhook_url}: throttled, retrying in {delay}s")
+                time.sleep(delay)
+                continue
+
+            result["ok"] = r.ok
+            if not r.ok:
+                result["error"] = r.text
+            return result
+
+        return result
+
+    def send_coalesced_alert(self, data, webhook_url, window_seconds=300, store=None):
+        """Send an alert unless an identical one was already sent within the window
+
+        Alerts are keyed on `lambda_name`/`function_name`/`status`. The first
+        alert of a window is sent straight away and later duplicates are only
+        counted. The summary of a closed window (occurrence count and first/last
+        timestamps) is sent by `flush_expired`, or added to the next alert with
+        the same key if that comes first.
+
+        Args:
+            data (dict): The event data recived when lambda was invoked.
+            webhook_url (str): The webhook url of the teams channel we're tring to send data to.
+            window_seconds (int): How long duplicates are suppressed for
+            store (obj): Where the state is kept, defaults to MemoryAlertStore.
+                Use DynamoAlertStore to share the window across containers.
+
+        Returns:
+            bool: True if the alert was sent or suppressed, False on failure
+        """
+
+        self.__logger.info("MsTeams.send_coalesced_alert: start")
+
+        if store is None:
+            store = MemoryAlertStore()
+
+        key = f'{data["lambda_name"]}|{data["function_name"]}|{data["status"]}'
+        now = int(time.time())
+        cutoff = now - window_seconds
+
+        # a duplicate inside the window, only count it
+        if self.__count_duplicate(store, key, now, cutoff):
+            return True
+
+        if not self.build_payload(data):
+            return False
+
+        try:
+            opened, previous = store.open_window(key, {
+                "window_start": now,
+                "first_seen": now,
+                "last_seen": now,
+                "count": 1,
+                "flushed": False,
+                "data": json.dumps(data, default=str),
+                "webhook_url": webhook_url,
+            }, cutoff)
+        except Exception as e:
+            # never lose an alert because the state store is unavailable
+            self.__logger.error(f"MsTeams.send_coalesced_alert: {e}")
+            opened, previous = True, None
+
+        if not opened:
+            # another container opened the window first and sends the alert
+            self.__count_duplicate(store, key, now, cutoff)
+            return True
+
+        # the previous window saw duplicates that were never summarized
+        if previous is not None and previous["count"] > 1 and not previous["flushed"]:
+            self.__add_summary_facts(previous["count"], previous["first_seen"], previous["last_seen"])
+
+        sent = self.send_webhook_message_to_channel(webhook_url)
+
+        if not sent:
+            # let the next alert open the window and try again
+            try:
+                store.close_window(key, now, previous)
+            except Exception as e:
+                self.__logger.error(f"MsTeams.send_coalesced_alert: {e}")
+
+        self.__logger.info("MsTeams.send_coalesced_alert: end")
+        return sent
+
+    def flush_expired(self, window_seconds=300, store=None):
+        """Send a summary card for every closed window that suppressed duplicates
+
+        Call this at the start of each invocation, or from a scheduled lambda
+        when the state is kept in a DynamoAlertStore, so the summary of an
+        alert storm is sent even when no further alert arrives.
+
+        Args:
+            window_seconds (int): How long duplicates are suppressed for
+            store (obj): Where the state is kept, defaults to MemoryAlertStore.
+
+        Returns:
+            int: the number of summaries sent
+        """
+
+        self.__logger.info("MsTeams.flush_expired: start")
+
+        if store is None:
+            store = MemoryAlertStore()
+
+        cutoff = int(time.time()) - window_seconds
+        sent = 0
+
+        try:
+            items = store.items()
+        except Exception as e:
+            self.__logger.error(f"MsTeams.flush_expired: {e}")
+            return sent
+
+        for key, state in items:
+            if state["window_start"] > cutoff or state["count"] <= 1 or state["flushed"]:
+                continue
+
+            if not self.build_payload(json.loads(state["data"])):
+                continue
+
+            self.__add_summary_facts(state["count"], state["first_seen"], state["last_seen"])
+
+            # claim the summary first, so only one container sends it
+            try:
+                if not store.set_flushed(key, state["window_start"], True):
+                    continue
+            except Exception as e:
+                self.__logger.error(f"MsTeams.flush_expired: {e}")
+                continue
+
+            if self.send_webhook_message_to_channel(state["webhook_url"]):
+                sent += 1
+                continue
+
+            try:
+                store.set_flushed(key, state["window_start"], False)
+            except Exception as e:
+                self.__logger.error(f"MsTeams.flush_expired: {e}")
+
+        self.__logger.info(f"MsTeams.flush_expired: end - {sent} summaries sent")
+        return sent
+
+    def __count_duplicate(self, store, key, now, cutoff):
+        """Count the alert in its open window, returns False if no window is open"""
+
+        try:
+            count = store.count(key, now, cutoff)
+        except Exception as e:
+            # never lose an alert because the state store is unavailable
+            self.__logger.error(f"MsTeams.send_coalesced_alert: {e}")
+            return False
+
+        if count is None:
+            return False
+
+        self.__logger.info(f"MsTeams.send_coalesced_alert: suppressed {key} - count {count}")
+        return True
+
+    def __add_summary_facts(self, count, first_seen, last_seen):
+        """Add the occurrence count and first/last timestamps to the payload"""
+
+        section = self.__payload["sections"][0]
+        section["facts"] = section["facts"] + [
+            {"name": "Occurrences", "value": str(count)},
+            {"name": "First Seen", "value": _format_timestamp(first_seen)},
+            {"name": "Last Seen", "value": _format_timestamp(last_seen)},
+        ]
+
+
+def _retry_after(response, default=1.0):
+    """Read the Retry-After header (in seconds) of a throttled response"""
+
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", default)))
+    except ValueError:
+        return default
+
+
+def _format_timestamp(timestamp):
+    """Format a unix timestamp for display in a card"""
+
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+class AsyncMsTeams(AsyncWrapper):
+    """asyncio counterpart of MsTeams, takes the same arguments
+
+    Payload building and everything else is shared with the wrapped MsTeams.
+    """
+
+    sync_class = MsTeams
+    async_methods = (
+        "send_webhook_message_to_channel",
+        "broadcast",
+        "send_coalesced_alert",
+        "flush_expired",
+    )
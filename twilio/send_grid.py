@@ -1,7 +1,10 @@
 import os
 import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+from sendgrid.helpers.mail import Mail, BatchId, SendAt
 
 
 class SendGrid():
@@ -113,3 +116,195 @@ class SendGrid():
             "statusCode": 200,
             "body": json.dumps({"message": "success"}),
         }
+
+    def send_to_many(self, subject, message_body, to_emails):
+        """Send the same email to many recipients in a single API call
+
+        Each address gets its own personalization, so recipients don't see
+        each other. SendGrid accepts up to 1000 personalizations per request.
+
+        Args:
+            subject (str): The subject of the email we're looking to send
+            message_body (str): The email message we're looking to send
+            to_emails (list): The email addresses, at most 1000
+        """
+
+        self.__logger.info(f"SendGrid.send_to_many: start - {len(to_emails)} recipients")
+
+        message = Mail(
+            from_email=self.from_email,
+            to_emails=to_emails,
+            subject=subject,
+            html_content=message_body,
+            is_multiple=True)
+
+        try:
+            sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
+            response = sg.send(message)
+            self.__logger.info(
+                f"SendGrid.send_to_many - response.status_code: {response.status_code}")
+
+        except Exception as e:
+            self.__logger.error(f"SendGrid.send_to_many: {e}")
+            return {
+                "statusCode": 500,
+                "body": json.dumps({"message": "Unable to send email"}),
+            }
+
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"message": "success"}),
+        }
+
+    def create_batch_id(self):
+        """Create a SendGrid batch ID used to group scheduled sends
+
+        docs: https://docs.sendgrid.com/api-reference/cancel-scheduled-sends/create-a-batch-id
+
+        Returns:
+            str: the batch id, or None if the request failed
+        """
+
+        self.__logger.info("SendGrid.create_batch_id: start")
+
+        try:
+            sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
+            response = sg.client.mail.batch.post()
+            batch_id = json.loads(response.body)["batch_id"]
+
+        except Exception as e:
+            self.__logger.error(f"SendGrid.create_batch_id: {e}")
+            return None
+
+        self.__logger.info(f"SendGrid.create_batch_id: end - batch_id {batch_id}")
+        return batch_id
+
+    def send_emails(self, messages, max_in_flight=10, send_at=None, batch_id=None):
+        """Send many emails while keeping `max_in_flight` requests open at once
+
+        When `send_at` is provided every message is scheduled under a single
+        batch ID, so the whole run is queued quickly and released together
+        (and can be paused or cancelled as one unit through the batch ID).
+
+        Args:
+            messages (list): dicts with `subject`, `message_body` and an optional
+                `to_emails` which defaults to `self.to_emails`
+            max_in_flight (int): the number of concurrent requests to SendGrid
+            send_at (int): optional unix timestamp at which the batch is released
+            batch_id (str): optional batch ID, one is created when `send_at` is set
+
+        Response body example:
+        {
+            "batch_id": "YOUR_BATCH_ID",
+            "sent": 98,
+            "failed": 2,
+            "status_codes": {"202": 98, "500": 2},
+            "latency_ms": {"p50": 120.5, "p90": 210.1, "p99": 480.2, "max": 512.0},
+            "elapsed_ms": 1450.3
+        }
+        """
+
+        self.__logger.info(f"SendGrid.send_emails: start - {len(messages)} messages")
+
+        if send_at is not None and batch_id is None:
+            batch_id = self.create_batch_id()
+            if batch_id is None:
+                return {
+                    "statusCode": 500,
+                    "body": json.dumps({"message": "Unable to create batch id"}),
+                }
+
+        # one client shared by every worker
+        sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
+
+        status_codes = {}
+        latencies = []
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            futures = [
+                executor.submit(self.__send_one, sg, message, send_at, batch_id)
+                for message in messages
+            ]
+
+            for future in as_completed(futures):
+                status_code, latency = future.result()
+                status_codes[str(status_code)] = status_codes.get(str(status_code), 0) + 1
+                latencies.append(latency)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        sent = sum(count for code, count in status_codes.items()
+                   if code.startswith("2"))
+
+        summary = {
+            "batch_id": batch_id,
+            "sent": sent,
+            "failed": len(messages) - sent,
+            "status_codes": status_codes,
+            "latency_ms": _latency_percentiles(latencies),
+            "elapsed_ms": round(elapsed_ms, 1),
+        }
+
+        self.__logger.info(f"SendGrid.send_emails: end - {summary}")
+
+        return {
+            "statusCode": 200 if sent == len(messages) else 207,
+            "body": json.dumps(summary),
+        }
+
+    def __send_one(self, sg, message, send_at, batch_id):
+        """Send a single message from the `send_emails` pipeline
+
+        Returns:
+            tuple: (status_code, latency in milliseconds)
+        """
+
+        started = time.perf_counter()
+
+        try:
+            mail = Mail(
+                from_email=self.from_email,
+                to_emails=message.get("to_emails", self.to_emails),
+                subject=message["subject"],
+                html_content=message["message_body"])
+
+            if send_at is not None:
+                mail.send_at = SendAt(send_at)
+            if batch_id is not None:
+                mail.batch_id = BatchId(batch_id)
+
+        except Exception as e:
+            # a malformed message is never sent, count it as a bad request
+            self.__logger.error(f"SendGrid.send_emails: invalid message: {e}")
+            return 400, (time.perf_counter() - started) * 1000
+
+        try:
+            response = sg.send(mail)
+            status_code = response.status_code
+
+        except Exception as e:
+            self.__logger.error(f"SendGrid.send_emails: {e}")
+            # python-http-client errors carry the api status code
+            status_code = getattr(e, "status_code", 500)
+
+        return status_code, (time.perf_counter() - started) * 1000
+
+
+def _latency_percentiles(latencies):
+    """Summarize a list of latencies (ms) as nearest-rank percentiles"""
+
+    if not latencies:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        index = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+        return round(ordered[index], 1)
+
+    return {
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": round(ordered[-1], 1),
+    }